@@ -1,87 +1,45 @@
 from mesa.time import BaseScheduler
 from agent import Car
 import pprint
-from collections import deque
+from batch import BatchEngine
+from conflicts import findConflictZones
+from registry import CarRegistry
+from signals import LightTimer
 
 class CautionScheduler(BaseScheduler):
-    def __init__(self, model):
+    def __init__(self, model, batch=False, profiler=None, ordering="caution"):
         super().__init__(model)
         self.traffic_lights = []
-        self.cars = []
-
-
-        self.danger_squares = set()  
-        self.pre_danger_squares = set()  
-
-        self.danger_squares_info = {}
-
-        w = self.model.width
-        h = self.model.height
-        graph = self.model.graph
-        # Solo funciona si son dos carriles en los lados
-        # Calculamos danger squares
-        for i in range(2, h-2):
-            left_col_pos = (1, i)
-            if left_col_pos in graph:
-                next = (2, i)
-                if next in graph[left_col_pos]:
-                    self.danger_squares.add(left_col_pos)
-                    points = graph[left_col_pos][0]
-
-                    self.danger_squares_info[left_col_pos] = {
-                        "direction":  ((points[0] - left_col_pos[0]) , (points[1] - left_col_pos[1])),
-                        "turn": (1,0)
-                        }
-
-        #     right_col_pos = (w-2, i)
-        #     if right_col_pos in graph:
-        #         next = (w-3, i)
-        #         if next in graph[right_col_pos]:
-        #             self.danger_squares.add(right_col_pos)
-        #             points = graph[right_col_pos][0]
-
-        #             self.danger_squares_info[right_col_pos] = {
-        #                 "direction":  ((points[0] - right_col_pos[0]) , (points[1] - right_col_pos[1])),
-        #                 "turn": (-1,0)
-        #                 }
-
-        
-        # for i in range(2, w-2):
-        #     bot_row_pos = (i, 1)
-        #     if bot_row_pos in graph:
-        #         next = (i, 2)
-        #         if next in graph[bot_row_pos]:
-        #             self.danger_squares.add(bot_row_pos)
-        #             points = graph[bot_row_pos][0]
-
-        #             self.danger_squares_info[bot_row_pos] = {
-        #                 "direction":  ((points[0] - bot_row_pos[0]) , (points[1] - bot_row_pos[1])),
-        #                 "turn": (0,1)
-        #                 }
-        #     top_row_pos = (i, h-2)
-        #     if top_row_pos in graph:
-        #         next = (i, h-3)
-        #         if next in graph[top_row_pos]:
-        #             self.danger_squares.add(top_row_pos)
-        #             points = graph[top_row_pos][0]
-
-        #             self.danger_squares_info[top_row_pos] = {
-        #                 "direction":  ((points[0] - top_row_pos[0]) , (points[1] - top_row_pos[1])),
-        #                 "turn": (0,-1)
-        #                 }
-
-        # Calculamos pre danger squares
-        for square in self.danger_squares:
-            dir = self.danger_squares_info[square]["direction"]
-            inv_dir = (dir[0] *-1, dir[1]*-1)
-            pre_danger = (square[0] + inv_dir[0],square[1] + inv_dir[1])
-            if pre_danger not in self.danger_squares:
-                self.pre_danger_squares.add(pre_danger)
-
-
-        # print("Danger squares:",self.danger_squares)
-        # print("PreDanger squares:", self.pre_danger_squares)
-        # pprint.pprint(self.danger_squares_info)
+        self.controllers = None  # Controladores por cruce, si los semaforos son adaptativos
+        self.timer = LightTimer([])  # Eventos de los semaforos de ciclo fijo
+        self.waiting = {}  # posicion del semaforo -> coche parado ahi en rojo
+        self.cars = CarRegistry()  # Orden de llegada, agregar y quitar en O(1)
+        self.engine = None
+        self.profiler = profiler  # PhaseProfiler, None si no se mide nada
+        # "caution": danger squares, resto y pre danger squares
+        # "dependency": cada coche despues del coche al que espera (ver dependencyOrder)
+        if ordering not in ("caution", "dependency"):
+            raise ValueError(f"Unknown ordering: {ordering}")
+        if batch and ordering != "caution":
+            raise ValueError("Batch mode only supports the caution ordering")
+        self.ordering = ordering
+
+
+        # Puntos de conflicto en cualquier parte del mapa, con las celdas de
+        # enfrente y de las vueltas ya calculadas para cada danger square
+        self.danger_squares, self.danger_squares_info, self.pre_danger_squares = (
+            findConflictZones(self.model.graph)
+        )
+        # La capa de ocupacion lleva el coche de cada danger y pre danger square
+        occupancy = self.model.occupancy
+        self.watched = occupancy.watched
+        occupancy.watch(
+            p for p in self.danger_squares | self.pre_danger_squares if occupancy.inBounds(p)
+        )
+
+        # Modo por lotes: el estado de los coches vive en arreglos de NumPy
+        if batch:
+            self.engine = BatchEngine(self)
             
 
          
@@ -89,106 +47,272 @@ class CautionScheduler(BaseScheduler):
     def add_traffic_lights(self, traffic_lights):
         """Add an agent to the group that will be activated first."""
         self.traffic_lights += traffic_lights
+        self.timer = LightTimer(self.traffic_lights)
+
+    def stepLights(self):
+        """
+        Avanza los semaforos (por eventos o con los controladores de cada cruce) y
+        suelta a los coches que esperaban en los que se pusieron en verde.
+        Regresa los semaforos que cambiaron.
+        """
+        if self.controllers is not None:
+            changed = [light for c in self.controllers for light in c.step()]
+        else:
+            changed = self.timer.step()
+
+        for light in changed:
+            if light.go:
+                car = self.waiting.pop(light.pos, None)
+                if car is not None:
+                    car.waiting = False
+        return changed
+
+    def holdAtRed(self, car):
+        self.waiting[car.position] = car
+        car.waiting = True
 
     def add_car(self, agent):
         """Add an agent to the group that will be activated last."""
-        self.cars.append(agent)
+        self.cars.add(agent)
+        if self.engine is not None:
+            self.engine.add(agent)
 
     def remove_car(self, agent):
         self.cars.remove(agent)
+        if self.engine is not None:
+            self.engine.remove(agent)
 
     def step(self):
         """Advance each agent in the custom order."""
+        if self.engine is not None:
+            self.engine.step()
+            return
+        self.cars.compact()
+        if self.ordering == "dependency":
+            self.stepDependency()
+            return
+
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.startStep()
+            stepCountBefore = {agent: agent.stepCount for agent in self.cars}
+
         # Activamos semáforos
        
-        for agent in self.traffic_lights:
-            agent.step()
+        self.stepLights()
+        if profiler is not None:
+            profiler.phase("lights", len(self.traffic_lights))
 
         # Acrivamos coches en danger squares
         self.activated_cars = set()
-        pre_danger_agents = []
+        watched = self.watched
         for square in self.danger_squares:
-            agents = self.model.grid.get_cell_list_contents([square])
-            for agent in agents:
-                if isinstance(agent, Car):
-                    # Checar coches enfrente y activalos antes
-                    self.activateFront(square)
-                    self.activateTurn(square)
-
-                    agent.step()
-                    self.activated_cars.add(agent)
-       
+            agent = watched[square]
+            if agent is not None:
+                # Checar coches enfrente y activalos antes
+                self.activateFront(square)
+                self.activateTurn(square)
+
+                agent.step()
+                self.activated_cars.add(agent)
+        if profiler is not None:
+            profiler.phase("danger", len(self.activated_cars))
+
+        # Coches en pre danger squares (no se mueven hasta su turno), en orden de llegada
+        pre_danger_agents = [
+            agent for agent in (watched[p] for p in self.pre_danger_squares if p in watched)
+            if agent is not None and agent not in self.activated_cars
+        ]
+        pre_danger_agents.sort(key=self.cars.order)
+        skip = self.activated_cars.union(pre_danger_agents)
+
         # Activamos coches que no estan en pre danger squares
         for agent in self.cars:
-            if agent not in self.activated_cars:
-                if agent.position in self.pre_danger_squares:
-                    pre_danger_agents.append(agent)
-                else:
-                    agent.step()
+            if agent not in skip:
+                agent.step()
+        if profiler is not None:
+            profiler.phase("normal")
 
         # Activamos coches en pre danger squares
         for agent in pre_danger_agents:
             agent.step()
 
+        if profiler is not None:
+            profiler.phase("pre_danger", len(pre_danger_agents))
+            stepped = [agent.stepCount - before for agent, before in stepCountBefore.items()]
+            skipped = sum(1 for n in stepped if n == 0)
+            normal = sum(1 for n in stepped if n > 0) - len(self.activated_cars) - len(pre_danger_agents)
+            profiler.endStep(
+                self.steps,
+                {"normal": normal},
+                sum(1 for n in stepped if n > 1),
+                skipped,
+            )
+
         self.steps += 1
         self.time += 1
 
 
-    def activateFront(self, square):
-        direction = self.danger_squares_info[square]["direction"]
-        step = 1
-        cars = deque([])
-        
-        while True:
-            hasCar = False
-            pos_to_check = (square[0] + direction[0] * step, square[1] + direction[1] * step)
-            if pos_to_check[0] < 0 or pos_to_check[0] >= self.model.width or pos_to_check[1] < 0 or pos_to_check[1] >= self.model.height:
-                break
-
-            agents = self.model.grid.get_cell_list_contents([pos_to_check])
-            for agent in agents:
-                if isinstance(agent, Car):
-                    cars.appendleft(agent)
-                    hasCar = True
-                    step += 1
-            if not hasCar:
-                break
-
-        while cars:
-            a = cars.popleft()
-            a.step()
-            self.activated_cars.add(a)
+    def dependencyOrder(self):
+        """
+        Orden de activacion a partir de a quien espera cada coche: un coche espera
+        al coche que ocupa su siguiente celda. Cada coche espera a lo mas a uno, asi
+        que los coches forman arboles con el coche de enfrente como raiz. Se recorren
+        en profundidad: despues de cada coche va toda la fila que lo espera, y una
+        fila completa puede avanzar en el mismo step.
+        Cuando varios coches quieren la misma celda (una incorporacion) va primero el
+        que tiene la fila mas larga detras. Si el que pierde se activa antes que la
+        fila del que gano, se cambia de carril a la celda que este libero y la fila
+        completa se queda parada hasta la esquina donde entran los coches.
+        Si la cadena se cierra en un ciclo, el ciclo entra al orden como una lista
+        (ver rotateCycle) antes de los coches que lo esperan.
+        Se recorren primero los coches en danger squares; despues el resto en orden
+        de llegada.
+        """
+        occupancy = self.model.occupancy
+        entering = {}  # Celda -> coches cuya siguiente celda es esa, en orden de llegada
+        waitsOn = {}
+        for agent in self.cars:
+            if agent.nextMove is not None and agent.position != agent.destination:
+                entering.setdefault(agent.nextMove, []).append(agent)
+                blocker = occupancy.carAt(agent.nextMove)
+                if blocker is not None:
+                    waitsOn[agent] = blocker
+
+        # Largo de la fila detras de cada coche (contandolo), de las hojas hacia
+        # enfrente; los coches de un ciclo nunca quedan sin pendientes
+        behind = dict.fromkeys(self.cars, 1)
+        pending = {}
+        for blocker in waitsOn.values():
+            pending[blocker] = pending.get(blocker, 0) + 1
+        leaves = [a for a in waitsOn if a not in pending]
+        while leaves:
+            agent = leaves.pop()
+            blocker = waitsOn[agent]
+            behind[blocker] += behind[agent]
+            pending[blocker] -= 1
+            if pending[blocker] == 0 and blocker in waitsOn:
+                leaves.append(blocker)
+
+        arrival = self.cars.order
+
+        def priority(agent):
+            return (-behind[agent], arrival(agent))
+
+        order = []
+        done = set()
+
+        def visit(entry):
+            stack = [entry]
+            while stack:
+                entry = stack.pop()
+                order.append(entry)
+                if isinstance(entry, list):
+                    queue = [a for c in entry for a in entering.get(c.position, ()) if a not in done]
+                else:
+                    queue = entering.get(entry.position, ())
+                if len(queue) > 1:
+                    queue = sorted(queue, key=priority)
+                for agent in reversed(queue):
+                    if agent not in done:
+                        done.add(agent)
+                        stack.append(agent)
+
+        first = [a for a in (self.watched[p] for p in self.danger_squares) if a is not None]
+        first.sort(key=arrival)
+        inDanger = set(first)
+        first += [a for a in self.cars if a not in inDanger]
+
+        for agent in first:
+            onChain = {}
+            cur = agent
+            while cur is not None and cur not in done and cur not in onChain:
+                onChain[cur] = len(onChain)
+                root = cur
+                cur = waitsOn.get(cur)
+            if not onChain:
+                continue
+            if cur in onChain:  # Ciclo: desde cur hasta el final de la cadena
+                cycle = list(onChain)[onChain[cur]:]
+                done.update(cycle)
+                visit(cycle)
+                continue
+            # Raiz: su siguiente celda esta libre; compite con las otras raices que
+            # quieren la misma celda
+            rivals = [root]
+            if root.nextMove is not None and root.position != root.destination:
+                rivals = [a for a in entering[root.nextMove] if a not in waitsOn and a not in done]
+                if len(rivals) > 1:
+                    rivals.sort(key=priority)
+            for rival in rivals:
+                done.add(rival)
+                visit(rival)
+
+        return order, len(waitsOn)
+
+    def rotateCycle(self, cycle):
+        # Un ciclo completo de coches (por ejemplo una glorieta llena) avanza a la vez,
+        # si ninguno esta en rojo; si no, cada coche se activa normal
+        occupancy = self.model.occupancy
+        if any(occupancy.isRed(a.position) for a in cycle):
+            for a in cycle:
+                a.step()
+            return
+
+        for a in cycle:
+            a.turnTowards(a.nextMove)
+        self.model.shiftCars(cycle)
+        for a in cycle:
+            a.advance(a.nextMove)
+            a.stepCount += 1
+
+    def stepDependency(self):
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.startStep()
+
+        self.stepLights()
+        if profiler is not None:
+            profiler.phase("lights", len(self.traffic_lights))
+
+        order, waiting = self.dependencyOrder()
+        if profiler is not None:
+            profiler.phase("graph", waiting)
+
+        activated = 0
+        for entry in order:
+            if isinstance(entry, list):
+                self.rotateCycle(entry)
+                activated += len(entry)
+            else:
+                entry.step()
+                activated += 1
+
+        if profiler is not None:
+            # Cada coche se activa exactamente una vez
+            profiler.phase("activate", activated)
+            profiler.endStep(self.steps, {}, 0, 0)
 
-        while cars:
-            a = cars.popleft()
-            a.step()
-            self.activated_cars.add(a)
+        self.steps += 1
+        self.time += 1
 
+    def activateFront(self, square):
+        self.activateChain(self.danger_squares_info[square]["front"])
 
     def activateTurn(self, square):
-        direction = self.danger_squares_info[square]["turn"]
-        step = 1
-        cars = deque([])
-    
-        while True:
-            hasCar = False
-            pos_to_check = (square[0] + direction[0] * step, square[1] + direction[1] * step)
-            if pos_to_check[0] < 0 or pos_to_check[0] >= self.model.width or pos_to_check[1] < 0 or pos_to_check[1] >= self.model.height:
-                break
-
-            agents = self.model.grid.get_cell_list_contents([pos_to_check])
-            for agent in agents:
-                if isinstance(agent, Car):
-                    cars.appendleft(agent)
-                    hasCar = True
-                    step += 1
-            if not hasCar:
+        for cells in self.danger_squares_info[square]["turnCells"]:
+            self.activateChain(cells)
+
+    def activateChain(self, cells):
+        # Coches seguidos en las celdas precalculadas, activando primero el mas lejano
+        occupancy = self.model.occupancy
+        cars = []
+        for pos in cells:
+            agent = occupancy.carAt(pos)
+            if agent is None:
                 break
+            cars.append(agent)
 
-        while cars:
-            a = cars.popleft()
+        for a in reversed(cars):
             a.step()
             self.activated_cars.add(a)
-
-
-
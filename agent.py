@@ -1,104 +1,92 @@
 from mesa import Agent
-from collections import deque
 import pprint
-import copy
 
 
-class Car(Agent):
+# Codigos de direccion: indice en DIRECTION_NAMES (lo que usa el frontend)
+DIRECTION_CODES = {(0, 1): 0, (0, -1): 1, (1, 0): 2, (-1, 0): 3}
+DIRECTION_NAMES = ["up", "down", "right", "left"]
+NO_DIRECTION = -1
+# Celdas relativas para cambiar de carril, por codigo de direccion
+LANE_CHANGES = [
+    [(-1, 1), (1, 1)],
+    [(-1, -1), (1, -1)],
+    [(1, 1), (1, -1)],
+    [(-1, 1), (-1, -1)],
+]
 
-     # Atributos de clase usados para logica del agente
-    possibleLaneChange = {
-        (0, 1): [(-1, 1), (1, 1)],
-        (0, -1): [(-1, -1), (1, -1)],
-        (1, 0): [(1, 1), (1, -1)],
-        (-1, 0): [(-1, 1), (-1, -1)],
-    }
-    directionsDecode = {
-        (0, 1): "up",
-        (0, -1): "down",
-        (1, 0): "right",
-        (-1, 0): "left",
-    }
 
-    def __init__(self, unique_id, model, pos):
-        
-        super().__init__(unique_id, model)  # Call the Agent constructor
+class Car:
+    """
+    Coche compacto: usa __slots__ en lugar de heredar de mesa.Agent (Agent no
+    define __slots__, asi que cada coche cargaria un __dict__). El MultiGrid solo
+    necesita unique_id, model y pos.
+    Los objetos se reciclan: al llegar a su destino el coche regresa a
+    model.carPool y model.newCar lo reinicia con reset().
+    """
+
+    __slots__ = (
+        "unique_id", "model", "pos", "originalPosition", "position", "timeStopped",
+        "destination", "plan", "planEpoch", "enteredAt", "nextMove", "stepCount",
+        "direction", "writtenCode", "waiting",
+    )
+
+    def __init__(self, unique_id, model, pos, destination=None):
+        self.model = model
+        self.reset(unique_id, pos, destination)
 
+    def reset(self, unique_id, pos, destination=None):
         # Atributos 
+        self.unique_id = unique_id
+        self.pos = None
         self.originalPosition = pos  
         self.position = pos
         self.timeStopped = 0
-        self.destination = self.model.getRandomDest() #Conseguri su destino
-        # print("D:",self.destination)
-        self.route = self.GetRoute(self.position) #Calcular ruta
-        self.routeIndex = 0 #Indice de donde va en la ruta
+        # Conseguir su destino (al azar si no lo da la demanda, ver demand.py)
+        self.destination = destination if destination is not None else self.model.getRandomDest()
+        self.plan = None # Ruta restante con rutas por congestion (ver CongestionRouter)
+        self.planEpoch = 0
+        self.enteredAt = self.model.schedule.steps
+        self.nextMove = self.GetRoute(self.position) #Siguiente celda de la ruta
         self.model.activeCars += 1
         self.stepCount = 0
-        self.direction = 0
-        self.directionWritten = "up"
+        self.direction = NO_DIRECTION
+        self.writtenCode = 0 # Ultima direccion valida ("up" al crearse)
+        self.waiting = False # Parado en un semaforo en rojo (ver CautionScheduler.holdAtRed)
+
+    @property
+    def directionWritten(self):
+        return DIRECTION_NAMES[self.writtenCode]
+
+    def getState(self):
+        # Todo menos model y pos (pos lo pone el grid al volver a colocarlo)
+        return tuple(getattr(self, name) for name in CAR_STATE)
+
+    def setState(self, model, state):
+        self.model = model
+        self.pos = None
+        for name, value in zip(CAR_STATE, state):
+            setattr(self, name, value)
 
     def GetRoute(self, start):
         """
-        Encuentra el camino más corto a una estación de carga usando búsqueda en anchura (BFS).
+        Consulta la ruta en el memo del modelo (model.memo).
         Retorna:
-            path: Lista de celdas que llevan a la estación de carga más cercana
+            La siguiente celda del camino más corto de start al destino
         """
-        # Llave de memoizacion
-        key = str(start) + str(self.destination)
-
-        # Checamos si ya existe la llave
-        if key in self.model.memo:
-            # print("Used memoization!")
-            self.model.memoCount += 1
-            # print("Original Pos:", self.originalPosition)
-            # print("Cur Pos:",self.position)
-            # print("Destination:",self.destination)
-            # print(self.model.memo[key])
-            return self.model.memo[key]
-
-        # Si no calculamos nuestra ruta con BFS
-        # print("Didnt use memoization!")
-        self.model.noMemoCount += 1
-        q = deque(
-            [(start, [])]
-        )  # Cola para BFS con la posición actual y el camino recorrido
-        visited = {start}  # Mantiene registro de las celdas visitadas
-
-        while q:
-            cur, path = q.popleft()  # Toma el primer elemento de la cola
-            if cur == self.destination:
-                self.model.memo[key] = copy.deepcopy(path)
-                return path
-
-            if cur not in self.model.graph:
-                continue
-            possible_moves = self.model.graph[cur] #Usamos el grafo para el BFS
-
-            for move in possible_moves:
-                if move not in visited:
-                    visited.add(move)  # Marca la celda como visitada
-                    q.append(
-                        (move, path + [move])
-                    )  # Añade la celda y el camino actualizado a la cola
+        if self.model.router is not None:
+            return self.model.router.route(self, start)
+        # El memo cuenta hits/misses y guarda la ruta como sufijo compartido
+        return self.model.memo.get(start, self.destination)
 
     def canChangeLane(self):
 
         #Checar si podemos cambiar ruta y si si calculamos la nueva ruta
-        if self.direction in Car.possibleLaneChange:
-            relatives_directions = Car.possibleLaneChange[self.direction]
-        else:
+        if self.direction == NO_DIRECTION:
             return False
 
-
-        for cell in relatives_directions:
+        for cell in LANE_CHANGES[self.direction]:
             to_move = (self.position[0] + cell[0], self.position[1] + cell[1])
-            if (
-                to_move[0] >= 0
-                and to_move[0] < self.model.width
-                and to_move[1] >= 0
-                and to_move[1] < self.model.height
-                and self.isEmpty(to_move)
-            ):
+            if self.model.occupancy.inBounds(to_move) and self.isEmpty(to_move):
                 self.ChangeRoute(to_move)
                 # print(self.route)
                 return True
@@ -108,99 +96,110 @@ class Car(Agent):
     def isEmpty(self, pos):
 
         # Regresa un booleando dependiedo si se considera vacio el lugar
-        agents = self.model.grid.get_cell_list_contents([pos])
-        blocked_agents = {Car, Obstacle, Traffic_Light, Destination}
-
-        return not any(
-            isinstance(a, agent_type) for a in agents for agent_type in blocked_agents
-        )
+        # (sin coche, obstaculo, semaforo ni destino)
+        return self.model.occupancy.isFree(pos)
 
     def ChangeRoute(self, next_move):
         # Cambiar la ruta
 
-        # print(next_move, self.GetRoute(next_move))
-        self.route = [next_move] + self.GetRoute(next_move)
-        self.routeIndex = 0
-        # self.route[0] = next_mov
+        # El siguiente paso es el carril de al lado, y de ahi se sigue la tabla
+        self.GetRoute(next_move)
+        self.nextMove = next_move
+
+    def turnTowards(self, next_move):
+        # Actualiza la direccion hacia next_move (y la escrita, para el frontend)
+        self.direction = DIRECTION_CODES.get(
+            (next_move[0] - self.position[0], next_move[1] - self.position[1]),
+            NO_DIRECTION,
+        )
+        if self.direction != NO_DIRECTION and self.direction != self.writtenCode:
+            self.writtenCode = self.direction
+            self.model.changes.carChanged(self)
+
+    def advance(self, next_move):
+        # Ya se movio a next_move en el grid: siguiente celda de la ruta
+        router = self.model.router
+        if router is not None:
+            self.nextMove = router.advance(self, self.position, next_move)
+        else:
+            self.nextMove = self.model.routes.nextHop(next_move, self.destination)
+        self.position = next_move
+        self.timeStopped = 0
 
     def move(self):
 
         if self.position == self.destination: #Si ya llego a su destino, destruirse y reportar sus estadisticas
             # print("GOT THERE")
-            self.model.grid.remove_agent(self)
+            self.model.removeCar(self)
             self.model.schedule.remove_car(self)
             self.model.activeCars -= 1
             self.model.arrived += 1
             self.model.addStepCount(self.stepCount)
+            self.model.releaseCar(self)
             return
 
-        next_move = self.route[self.routeIndex]
-
-        self.direction = (
-            next_move[0] - self.position[0],
-            next_move[1] - self.position[1],
-        )
-        if self.direction in Car.directionsDecode:
-            self.directionWritten = Car.directionsDecode[self.direction]
+        next_move = self.nextMove
+        self.turnTowards(next_move)
 
         #Logica de moverse
-        canMove = True
+        red = self.model.occupancy.isRed(self.position)
+        canMove = not red
 
-        for agent in self.model.grid.get_cell_list_contents([self.position]):
-            if isinstance(agent, Traffic_Light) and not agent.go:
+        if canMove and self.model.occupancy.hasCar(next_move):
+            if self.timeStopped >= 1 and self.canChangeLane():
+                next_move = self.nextMove
+            else:
                 canMove = False
 
-        if canMove:
-            for agent in self.model.grid.get_cell_list_contents([next_move]):
-                if isinstance(agent, Car):
-                    if (
-                        len(self.route) > 0
-                        and self.timeStopped >= 1
-                        and self.canChangeLane()
-                    ):
-                        next_move = self.route[self.routeIndex]
-                    else:
-                        canMove = False
-
         if canMove: # Si si se puede mover moverse
-            self.model.grid.move_agent(self, next_move)
-            self.position = next_move
-            self.routeIndex += 1
-            self.timeStopped = 0
+            self.model.moveCar(self, next_move)
+            self.advance(next_move)
         else:
             self.timeStopped += 1
+            if red: # No se vuelve a revisar hasta que el semaforo cambie
+                self.model.schedule.holdAtRed(self)
+
+    def wait(self):
+        # Lo mismo que move() en rojo: no cambia de direccion ni de carril
+        self.timeStopped += 1
 
     def step(self):
         """
         Determines the new direction it will take, and then moves
         """
-        self.move()
+        if self.waiting:
+            self.wait()
+        else:
+            self.move()
         self.stepCount += 1
 
 
+CAR_STATE = tuple(name for name in Car.__slots__ if name not in ("model", "pos"))
+
+
 class Traffic_Light(Agent):
     """
     Traffic light. Where the traffic lights are in the grid.
     """
 
-    def __init__(self, unique_id, model, start, cycle):
+    def __init__(self, unique_id, model, start, cycle, green=None):
         super().__init__(unique_id, model)
         self.direction = "up"
         self.go = start
         self.cycle = cycle
+        self.green = green if green is not None else cycle  # Verde base con controlador adaptativo
         self.cur = 0
 
     def step(self):
        #Cambia de estado cada "cycle" steps
         self.cur += 1
-        if not self.go:
-            if self.cur >= self.cycle:
-                self.cur = 0
-                self.go = True
-        else:
-            if self.cur >= self.cycle:
-                self.cur = 0
-                self.go = False
+        if self.cur >= self.cycle:
+            self.flip()
+
+    def flip(self):
+        self.cur = 0
+        self.go = not self.go
+        self.model.changes.lightChanged(self)
 
 
 class Destination(Agent):
@@ -2,12 +2,19 @@
 # Python flask server to interact with webGL.
 # Octavio Navarro. 2024
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, make_response, Response
 from flask_cors import CORS, cross_origin
 from model import CityModel
-from agent import Car, Traffic_Light, Obstacle, Road
+from mapcompiler import loadMap
+from agent import Obstacle, Road
 import requests
 import json
+import hashlib
+import hmac
+import os
+import secrets
+import struct
+import numpy as np
 
 
 # Size of the board:
@@ -16,6 +23,7 @@ width = 28
 height = 28
 randomModel = None
 currentStep = 0
+staticPayloads = {}  # Respuestas de edificios y calles, se calculan una vez en /init
 
 # This application will be used to interact with WebGL
 app = Flask("Traffic Project")
@@ -27,19 +35,20 @@ cors = CORS(app, origins=["http://localhost"])
 @app.route("/init", methods=["POST"])
 @cross_origin()
 def initModel():
-    global currentStep, randomModel, number_agents, width, height
+    global currentStep, randomModel, number_agents, width, height, staticPayloads
 
     if request.method == "POST":
         try:
-            with open("./2024_base.txt") as baseFile:
-                lines = baseFile.readlines()
-                width = len(lines[0]) - 1
-                height = len(lines)
+            # El mapa compilado (grafo y rutas) se reutiliza entre llamadas a /init
+            compiled = loadMap("./2024_base.txt")
+            width = compiled.width
+            height = compiled.height
 
             currentStep = 0
 
             # Create the model using the parameters sent by the application
-            randomModel = CityModel(width, height, lines, 100)
+            randomModel = CityModel(width, height, compiled.lines, 100, prebuilt=compiled.prebuilt())
+            staticPayloads = buildStaticPayloads(randomModel)
 
             # Return a message to saying that the model was created successfully
             return jsonify(
@@ -62,19 +71,7 @@ def getCars():
 
     if request.method == "GET":
         try:
-            carPositions = []
-            for cell_content, (x, y) in randomModel.grid.coord_iter():
-                for a in cell_content:
-                    if isinstance(a, Car):
-                        carPositions.append(
-                            {
-                                "id": str(a.unique_id),
-                                "x": x,
-                                "y": 1,
-                                "z": y,
-                                "direction": a.directionWritten,
-                            }
-                        )
+            carPositions = [carData(a) for a in randomModel.schedule.cars]
 
             return jsonify({"positions": carPositions})
         except Exception as e:
@@ -82,22 +79,67 @@ def getCars():
             return jsonify({"message": "Error with the car positions"}), 500
 
 
+def carData(a):
+    x, y = a.pos
+    return {"id": str(a.unique_id), "x": x, "y": 1, "z": y, "direction": a.directionWritten}
+
+
+def trafficLightData(a):
+    x, y = a.pos
+    return {
+        "id": str(a.unique_id),
+        "x": x,
+        "y": 1,
+        "z": y,
+        "direction": a.direction,
+        "go": a.go,
+    }
+
+
+def buildStaticPayloads(model):
+    # Los edificios y las calles no cambian despues de CityModel.__init__,
+    # asi que se serializan una sola vez con un ETag para las peticiones repetidas
+    buildingPositions = []
+    roadPositions = []
+    for a in model.staticAgents():
+        x, y = a.pos
+        if isinstance(a, Obstacle):
+            buildingPositions.append(
+                {"id": str(a.unique_id), "x": x, "y": 1, "z": y}
+            )
+        elif isinstance(a, Road):
+            roadPositions.append(
+                {
+                    "id": str(a.unique_id),
+                    "x": x,
+                    "y": 0,  # Suponiendo que las calles están en y=0
+                    "z": y,
+                    "direction": a.direction,
+                }
+            )
+
+    payloads = {}
+    for name, positions in [("buildings", buildingPositions), ("roads", roadPositions)]:
+        body = json.dumps({"positions": positions})
+        payloads[name] = (body, hashlib.sha1(body.encode()).hexdigest())
+    return payloads
+
+
+def staticResponse(name):
+    # Regresa 304 si el cliente ya tiene la misma version (If-None-Match)
+    body, etag = staticPayloads[name]
+    response = make_response(body)
+    response.mimetype = "application/json"
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
 @app.route("/getBuildings", methods=["GET"])
 @cross_origin()
 def getBuildings():
-    global randomModel
-
     if request.method == "GET":
         try:
-            buildingPositions = []
-            for cell_content, (x, y) in randomModel.grid.coord_iter():
-                for a in cell_content:
-                    if isinstance(a, Obstacle):
-                        buildingPositions.append(
-                            {"id": str(a.unique_id), "x": x, "y": 1, "z": y}
-                        )
-
-            return jsonify({"positions": buildingPositions})
+            return staticResponse("buildings")
         except Exception as e:
             print(e)
             return jsonify({"message": "Error with building positions"}), 500
@@ -110,21 +152,9 @@ def getTrafficLights():
 
     if request.method == "GET":
         try:
-            trafficLightPositions = []
-            for cell_content, (x, y) in randomModel.grid.coord_iter():
-                for a in cell_content:
-                    if isinstance(a, Traffic_Light):
-                        trafficLightPositions.append(
-                            {
-                                "id": str(a.unique_id),
-                                "x": x,
-                                "y": 1,
-                                "z": y,
-                                "direction": a.direction,
-                                "go": a.go,
-                            }
-                        )
-            print(jsonify({"positions": trafficLightPositions}))
+            trafficLightPositions = [
+                trafficLightData(a) for a in randomModel.schedule.traffic_lights
+            ]
             return jsonify({"positions": trafficLightPositions})
         except Exception as e:
             print(e)
@@ -134,25 +164,9 @@ def getTrafficLights():
 @app.route("/getRoads", methods=["GET"])
 @cross_origin()
 def getRoads():
-    global randomModel
-
     if request.method == "GET":
         try:
-            roadPositions = []
-            for cell_content, (x, y) in randomModel.grid.coord_iter():
-                for a in cell_content:
-                    if isinstance(a, Road):
-                        roadPositions.append(
-                            {
-                                "id": str(a.unique_id),
-                                "x": x,
-                                "y": 0,  # Suponiendo que las calles están en y=0
-                                "z": y,
-                                "direction": a.direction,
-                            }
-                        )
-
-            return jsonify({"positions": roadPositions})
+            return staticResponse("roads")
         except Exception as e:
             print(e)
             return jsonify({"message": "Error with the road positions"}), 500
@@ -170,35 +184,12 @@ def updateModel():
             currentStep += 1
 
             # Obtener posiciones de los carros
-            carPositions = []
-            for cell_content, (x, y) in randomModel.grid.coord_iter():
-                for a in cell_content:
-                    if isinstance(a, Car):
-                        carPositions.append(
-                            {
-                                "id": str(a.unique_id),
-                                "x": x,
-                                "y": 1,
-                                "z": y,
-                                "direction": a.directionWritten,
-                            }
-                        )
+            carPositions = [carData(a) for a in randomModel.schedule.cars]
 
             # Obtener posiciones de los semáforos
-            trafficLightPositions = []
-            for cell_content, (x, y) in randomModel.grid.coord_iter():
-                for a in cell_content:
-                    if isinstance(a, Traffic_Light):
-                        trafficLightPositions.append(
-                            {
-                                "id": str(a.unique_id),
-                                "x": x,
-                                "y": 1,
-                                "z": y,
-                                "direction": a.direction,
-                                "go": a.go,
-                            }
-                        )
+            trafficLightPositions = [
+                trafficLightData(a) for a in randomModel.schedule.traffic_lights
+            ]
 
             # Retornar ambas listas en la respuesta JSON
             return jsonify(
@@ -214,6 +205,183 @@ def updateModel():
             return jsonify({"message": "Error during step."}), 500
 
 
+# Igual que /update pero solo regresa lo que cambio desde el step `since`
+# que ya tiene el cliente. Si el cliente no manda `since` o se quedo muy atras
+# se regresa el estado completo con "full": true.
+@app.route("/updateDelta", methods=["GET"])
+@cross_origin()
+def updateDelta():
+    global currentStep, randomModel
+    if request.method == "GET":
+        try:
+            since = request.args.get("since", default=-1, type=int)
+
+            randomModel.step()
+            currentStep += 1
+            seq = randomModel.schedule.steps
+
+            delta = randomModel.changes.since(since)
+            if delta is None:
+                return jsonify(
+                    {
+                        "seq": seq,
+                        "full": True,
+                        "cars": [carData(a) for a in randomModel.schedule.cars],
+                        "arrived": [],
+                        "trafficLights": [
+                            trafficLightData(a) for a in randomModel.schedule.traffic_lights
+                        ],
+                    }
+                )
+
+            cars, arrived, lights = delta
+            carsById = randomModel.occupancy.cars
+            lightsById = {a.unique_id: a for a in randomModel.schedule.traffic_lights}
+            return jsonify(
+                {
+                    "seq": seq,
+                    "full": False,
+                    "cars": [carData(carsById[i]) for i in cars if i in carsById],
+                    "arrived": [str(i) for i in arrived],
+                    "trafficLights": [trafficLightData(lightsById[i]) for i in lights],
+                }
+            )
+        except Exception as e:
+            print(e)
+            return jsonify({"message": "Error during step."}), 500
+
+
+def packState(model):
+    """
+    Empaqueta el estado en binario (little endian) para cargarlo directo en typed arrays:
+        uint32 step, uint32 numCars, uint32 numLights
+        int32 ids[numCars]
+        uint16 x[numCars]
+        uint16 z[numCars]
+        uint8 direction[numCars]    (0 up, 1 down, 2 right, 3 left)
+        uint8 lights[ceil(numLights / 8)]    (bit i = go del semaforo i, en el orden de /getTrafficLights)
+    """
+    cars = model.schedule.cars
+    n = len(cars)
+    ids = np.fromiter((a.unique_id for a in cars), dtype="<i4", count=n)
+    xs = np.fromiter((a.pos[0] for a in cars), dtype="<u2", count=n)
+    zs = np.fromiter((a.pos[1] for a in cars), dtype="<u2", count=n)
+    directions = np.fromiter((a.writtenCode for a in cars), dtype=np.uint8, count=n)
+
+    lights = model.schedule.traffic_lights
+    go = np.fromiter((a.go for a in lights), dtype=bool, count=len(lights))
+    lightBits = np.packbits(go, bitorder="little")
+
+    header = struct.pack("<III", model.schedule.steps, n, len(lights))
+    return b"".join(
+        [header, ids.tobytes(), xs.tobytes(), zs.tobytes(), directions.tobytes(), lightBits.tobytes()]
+    )
+
+
+# Igual que /update pero regresa el estado empaquetado en binario (ver packState)
+@app.route("/updateBinary", methods=["GET"])
+@cross_origin()
+def updateBinary():
+    global currentStep, randomModel
+    if request.method == "GET":
+        try:
+            randomModel.step()
+            currentStep += 1
+            return Response(packState(randomModel), mimetype="application/octet-stream")
+        except Exception as e:
+            print(e)
+            return jsonify({"message": "Error during step."}), 500
+
+
+# Estados guardados con /snapshot (los mas viejos se tiran), por id
+MAX_SNAPSHOTS = 16
+snapshots = {}
+
+# Los estados son pickle: /restore solo acepta los que firmo este servidor
+SNAPSHOT_KEY = os.environ.get("SNAPSHOT_KEY", "").encode() or secrets.token_bytes(32)
+SIGNATURE_SIZE = hashlib.sha256().digest_size
+
+
+def signSnapshot(data):
+    return hmac.new(SNAPSHOT_KEY, data, hashlib.sha256).digest() + data
+
+
+def verifySnapshot(signed):
+    # Regresa el estado sin la firma, o None si la firma no coincide
+    signature, data = signed[:SIGNATURE_SIZE], signed[SIGNATURE_SIZE:]
+    expected = hmac.new(SNAPSHOT_KEY, data, hashlib.sha256).digest()
+    return data if hmac.compare_digest(signature, expected) else None
+
+
+# Guarda el estado actual del modelo y regresa su id
+@app.route("/snapshot", methods=["POST"])
+@cross_origin()
+def snapshotModel():
+    global randomModel
+    if request.method == "POST":
+        try:
+            data = randomModel.snapshot()
+            snapshotId = hashlib.sha1(data).hexdigest()[:16]
+            snapshots.pop(snapshotId, None)
+            snapshots[snapshotId] = data
+            while len(snapshots) > MAX_SNAPSHOTS:
+                del snapshots[next(iter(snapshots))]
+            return jsonify(
+                {"id": snapshotId, "step": randomModel.schedule.steps, "bytes": len(data)}
+            )
+        except Exception as e:
+            print(e)
+            return jsonify({"message": "Error saving the model state"}), 500
+
+
+# Descarga un estado guardado (firmado), para restaurarlo despues con /restore
+@app.route("/snapshot/<snapshotId>", methods=["GET"])
+@cross_origin()
+def getSnapshot(snapshotId):
+    if snapshotId not in snapshots:
+        return jsonify({"message": "Unknown snapshot"}), 404
+    return Response(signSnapshot(snapshots[snapshotId]), mimetype="application/octet-stream")
+
+
+# Regresa el modelo a un estado guardado: ?id=<id> de /snapshot, o en el cuerpo
+# (application/octet-stream) un estado descargado de /snapshot/<id> con la misma
+# SNAPSHOT_KEY. Responde con el estado completo, como /update.
+@app.route("/restore", methods=["POST"])
+@cross_origin()
+def restoreModel():
+    global currentStep, randomModel
+    if request.method == "POST":
+        snapshotId = request.args.get("id")
+        if snapshotId is not None:
+            if snapshotId not in snapshots:
+                return jsonify({"message": "Unknown snapshot"}), 404
+            data = snapshots[snapshotId]
+        else:
+            data = verifySnapshot(request.get_data())
+            if data is None:
+                return jsonify({"message": "Invalid snapshot signature"}), 400
+        try:
+            randomModel.restore(data)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        except Exception as e:
+            print(e)
+            return jsonify({"message": "Error restoring the model state"}), 500
+
+        currentStep = randomModel.schedule.steps
+        return jsonify(
+            {
+                "message": f"Model restored to step {currentStep}.",
+                "currentStep": currentStep,
+                "seq": currentStep,
+                "cars": [carData(a) for a in randomModel.schedule.cars],
+                "trafficLights": [
+                    trafficLightData(a) for a in randomModel.schedule.traffic_lights
+                ],
+            }
+        )
+
+
 if __name__ == "__main__":
     # Run the flask server in port 8585
 
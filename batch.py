@@ -0,0 +1,504 @@
+import numpy as np
+from occupancy import ROAD
+from agent import DIRECTION_CODES, LANE_CHANGES, NO_DIRECTION
+
+# Tabla para calcular el codigo de direccion con arreglos: indice (dx+1)*3 + (dy+1)
+_DIRECTION_LOOKUP = np.full(9, -1, dtype=np.int8)
+for (dx, dy), code in DIRECTION_CODES.items():
+    _DIRECTION_LOOKUP[(dx + 1) * 3 + (dy + 1)] = code
+
+NO_RANK = np.iinfo(np.int64).max
+
+
+class BatchEngine:
+    """
+    Motor de pasos por lotes para CautionScheduler.
+    Guarda el estado de los coches en arreglos de NumPy (posicion, siguiente celda,
+    destino, timeStopped, stepCount) y resuelve un tick completo con operaciones
+    de arreglos. Da exactamente los mismos resultados que llamar Car.step() uno
+    por uno en el orden del scheduler:
+        - Los coches en danger squares y sus cadenas se activan primero, uno por uno.
+        - El resto se ordena por rango (orden de self.cars y luego pre danger).
+          Los coches sin conflicto (celda libre y nadie mas la pide) se mueven
+          con arreglos; solo los que compiten por una celda se resuelven en orden.
+    Cada tick solo se escriben carIds de la capa de ocupacion (lo que consultan el
+    spawn y la demanda) y los ids que cambiaron en model.changes, con arreglos. Los
+    objetos Car (posicion, siguiente celda, direccion, timeStopped, stepCount), el
+    MultiGrid y occupancy.watched se actualizan al llamar sync(), solo cuando alguien
+    los va a leer (snapshot, gridlock).
+    Cada tick cuesta alrededor de un milisegundo fijo en operaciones de arreglos, asi
+    que conviene desde unos cientos de coches; con pocos coches el modo por coche es
+    mas rapido (ver benchmark.py).
+    """
+
+    def __init__(self, scheduler, capacity=1024):
+        self.scheduler = scheduler
+        self.model = scheduler.model
+        self.occupancy = self.model.occupancy
+        w, h = self.model.width, self.model.height
+        self.width = w
+        self.height = h
+
+        # Capas del mapa
+        self.occ = np.full((w, h), -1, dtype=np.int64)  # slot del coche en cada celda
+        self.red = np.zeros((w, h), dtype=bool)  # Se actualiza solo con los semaforos que cambian
+        self.redStale = True  # Los controladores pueden cambiar semaforos despues de crear el motor
+        self.preDanger = np.zeros((w, h), dtype=bool)
+        for pos in scheduler.pre_danger_squares:
+            if self.occupancy.inBounds(pos):
+                self.preDanger[pos] = True
+        self.lightPositions = list(self.occupancy.lights.keys())
+        self.lightX = np.array([p[0] for p in self.lightPositions], dtype=np.int64)
+        self.lightY = np.array([p[1] for p in self.lightPositions], dtype=np.int64)
+
+        # Siguiente celda por destino (ver RouteTable.nextCellArray)
+        routes = self.model.routes
+        self.destinationIds = routes.destinationIds
+        self.roadIndex, self.moveStart, self.moveCells, self.nextMove = routes.nextCellArray(h)
+
+        # Estado de los coches (struct of arrays)
+        self.agents = [None] * capacity
+        self.slots = {}  # unique_id -> slot
+        self.freeSlots = list(range(capacity - 1, -1, -1))
+        self.nextSeq = 0
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.ids = np.zeros(capacity, dtype=np.int64)  # unique_id de cada slot
+        self.seq = np.zeros(capacity, dtype=np.int64)
+        self.posX = np.zeros(capacity, dtype=np.int64)
+        self.posY = np.zeros(capacity, dtype=np.int64)
+        self.nextX = np.zeros(capacity, dtype=np.int64)
+        self.nextY = np.zeros(capacity, dtype=np.int64)
+        self.destX = np.zeros(capacity, dtype=np.int64)
+        self.destY = np.zeros(capacity, dtype=np.int64)
+        self.destId = np.zeros(capacity, dtype=np.int64)
+        self.timeStopped = np.zeros(capacity, dtype=np.int64)
+        self.stepCount = np.zeros(capacity, dtype=np.int64)
+        self.dirCode = np.full(capacity, -1, dtype=np.int8)
+        self.writtenCode = np.full(capacity, -1, dtype=np.int8)  # ultima direccion escrita al Car
+
+        # Estado por tick
+        self.vacRank = np.full(capacity, NO_RANK, dtype=np.int64)
+        self.moved = np.zeros(capacity, dtype=bool)
+        self.activated = np.zeros(capacity, dtype=bool)
+        self.startX = np.zeros(capacity, dtype=np.int64)
+        self.startY = np.zeros(capacity, dtype=np.int64)
+        self.arrivedSlots = []
+        self.stale = False  # Los objetos Car y el MultiGrid van atras de los arreglos
+
+    _ARRAYS = ["alive", "ids", "seq", "posX", "posY", "nextX", "nextY", "destX", "destY",
+               "destId", "timeStopped", "stepCount", "dirCode", "writtenCode", "vacRank", "moved",
+               "activated", "startX", "startY"]
+
+    def grow(self):
+        old = len(self.agents)
+        new = old * 2
+        for name in BatchEngine._ARRAYS:
+            arr = getattr(self, name)
+            grown = np.zeros(new, dtype=arr.dtype)
+            grown[:old] = arr
+            setattr(self, name, grown)
+        self.vacRank[old:] = NO_RANK
+        self.dirCode[old:] = -1
+        self.writtenCode[old:] = -1
+        self.agents += [None] * old
+        self.freeSlots = list(range(new - 1, old - 1, -1)) + self.freeSlots
+
+    def add(self, car):
+        if not self.freeSlots:
+            self.grow()
+        i = self.freeSlots.pop()
+        self.agents[i] = car
+        self.slots[car.unique_id] = i
+        self.alive[i] = True
+        self.ids[i] = car.unique_id
+        self.seq[i] = self.nextSeq
+        self.nextSeq += 1
+        self.posX[i], self.posY[i] = car.position
+        self.setNext(i, car.nextMove)
+        self.destX[i], self.destY[i] = car.destination
+        self.destId[i] = self.destinationIds[car.destination]
+        self.timeStopped[i] = car.timeStopped
+        self.stepCount[i] = car.stepCount
+        self.dirCode[i] = car.direction
+        self.writtenCode[i] = car.writtenCode
+        self.occ[car.position] = i
+
+    def remove(self, car):
+        i = self.slots.pop(car.unique_id)
+        if self.occ[self.posX[i], self.posY[i]] == i:
+            self.occ[self.posX[i], self.posY[i]] = -1
+        self.alive[i] = False
+        self.agents[i] = None
+        self.freeSlots.append(i)
+
+    def setNext(self, i, cell):
+        if cell is None:
+            self.nextX[i], self.nextY[i] = -1, -1
+        else:
+            self.nextX[i], self.nextY[i] = cell
+
+    def sync(self):
+        """Escribe el estado de los arreglos a los objetos Car, al MultiGrid y a occupancy.watched."""
+        if not self.stale:
+            return
+        grid = self.model.grid
+        slots = np.flatnonzero(self.alive)
+        state = zip(
+            slots.tolist(), self.posX[slots].tolist(), self.posY[slots].tolist(),
+            self.nextX[slots].tolist(), self.nextY[slots].tolist(),
+            self.timeStopped[slots].tolist(), self.stepCount[slots].tolist(),
+            self.dirCode[slots].tolist(), self.writtenCode[slots].tolist(),
+        )
+        for i, x, y, nx, ny, timeStopped, stepCount, direction, written in state:
+            agent = self.agents[i]
+            pos = (x, y)
+            if agent.pos != pos:
+                grid.move_agent(agent, pos)
+            agent.position = pos
+            agent.nextMove = None if nx < 0 else (nx, ny)
+            agent.timeStopped = timeStopped
+            agent.stepCount = stepCount
+            agent.direction = direction
+            agent.writtenCode = written
+        self.occupancy.refreshWatched()
+        self.stale = False
+
+    # Paso por coche (mismas reglas que Car.move), se usa para danger squares y conflictos
+    def hasCar(self, x, y, rank):
+        # Hay coche si la celda esta ocupada y el que esta ahi no se va antes de este rango
+        o = self.occ.item(x, y)
+        return o >= 0 and self.vacRank.item(o) >= rank
+
+    def isFree(self, x, y, rank):
+        return (
+            0 <= x < self.width
+            and 0 <= y < self.height
+            and self.occupancy.cells[x, y] <= ROAD
+            and not self.hasCar(x, y, rank)
+        )
+
+    def stepOne(self, i, rank=NO_RANK):
+        if not self.alive[i]:
+            return
+        occ = self.occ
+        px, py = self.posX.item(i), self.posY.item(i)
+        if px == self.destX.item(i) and py == self.destY.item(i):
+            self.arrive(i)
+            return
+
+        nx, ny = self.nextX.item(i), self.nextY.item(i)
+        direction = DIRECTION_CODES.get((nx - px, ny - py), NO_DIRECTION)
+        if direction != NO_DIRECTION:
+            self.dirCode[i] = direction
+
+        canMove = not self.red[px, py]
+        if canMove and self.hasCar(nx, ny, rank):
+            if self.timeStopped[i] >= 1 and self.changeLane(i, px, py, direction, rank):
+                nx, ny = self.nextX.item(i), self.nextY.item(i)
+            else:
+                canMove = False
+
+        if canMove:
+            if occ[px, py] == i:
+                occ[px, py] = -1
+            occ[nx, ny] = i
+            self.posX[i] = nx
+            self.posY[i] = ny
+            column = self.roadIndex.item(nx, ny)
+            k = self.nextMove.item(self.destId.item(i), column)
+            if k >= 0:
+                cell = self.moveCells.item(self.moveStart.item(column) + k)
+                self.nextX[i], self.nextY[i] = divmod(cell, self.height)
+            else:
+                self.nextX[i] = self.nextY[i] = -1
+            self.timeStopped[i] = 0
+            self.moved[i] = True
+        else:
+            self.timeStopped[i] += 1
+        self.stepCount[i] += 1
+
+    def changeLane(self, i, px, py, direction, rank):
+        if direction == NO_DIRECTION:
+            return False
+        for cell in LANE_CHANGES[direction]:
+            x, y = px + cell[0], py + cell[1]
+            if self.isFree(x, y, rank):
+                # Igual que Car.ChangeRoute, se consulta el memo para llevar la cuenta
+                self.model.memo.get((x, y), self.agents[i].destination)
+                self.nextX[i], self.nextY[i] = x, y
+                return True
+        return False
+
+    def refreshRed(self):
+        self.red[:] = False
+        if self.lightPositions:
+            go = np.array([self.occupancy.lights[p].go for p in self.lightPositions], dtype=bool)
+            self.red[self.lightX[~go], self.lightY[~go]] = True
+        self.redStale = False
+
+    def arrive(self, i):
+        px, py = self.posX[i], self.posY[i]
+        if self.occ[px, py] == i:
+            self.occ[px, py] = -1
+        self.alive[i] = False
+        self.arrivedSlots.append(i)
+
+    def activateChain(self, cells):
+        # Igual que CautionScheduler.activateChain
+        cars = []
+        for pos in cells:
+            o = self.occ.item(pos)
+            if o < 0:
+                break
+            cars.append(o)
+        for o in reversed(cars):
+            self.stepOne(o)
+            self.activated[o] = True
+
+    def step(self):
+        scheduler = self.scheduler
+        profiler = scheduler.profiler
+        if profiler is not None:
+            profiler.startStep()
+            stepCountBefore = self.stepCount.copy()
+
+        # Semaforos
+        changed = scheduler.stepLights()
+        if self.redStale:
+            self.refreshRed()
+        else:
+            for light in changed:
+                self.red[light.pos] = not light.go
+        if profiler is not None:
+            profiler.phase("lights", len(scheduler.traffic_lights))
+
+        self.moved[:] = False
+        self.activated[:] = False
+        self.vacRank[:] = NO_RANK
+        self.startX[:] = self.posX
+        self.startY[:] = self.posY
+        self.arrivedSlots = []
+        aliveAtStart = self.alive.copy()
+
+        # Coches en danger squares, uno por uno
+        for square in scheduler.danger_squares:
+            o = self.occ[square]
+            if o >= 0:
+                info = scheduler.danger_squares_info[square]
+                self.activateChain(info["front"])
+                for cells in info["turnCells"]:
+                    self.activateChain(cells)
+                self.stepOne(o)
+                self.activated[o] = True
+        if profiler is not None:
+            profiler.phase("danger", int(self.activated.sum()))
+
+        rest = self.stepRest(aliveAtStart)
+        if profiler is not None:
+            profiler.phase("rest", rest)
+            # Veces que se activo cada coche (al llegar no se incrementa stepCount)
+            arrived = np.zeros(len(self.agents), dtype=bool)
+            arrived[self.arrivedSlots] = True
+            stepped = (self.stepCount - stepCountBefore + arrived)[aliveAtStart]
+
+        self.commit()
+        if profiler is not None:
+            profiler.phase("commit", len(self.arrivedSlots) + int(self.moved.sum()))
+            profiler.endStep(
+                scheduler.steps, {}, int((stepped > 1).sum()), int((stepped == 0).sum())
+            )
+
+        scheduler.steps += 1
+        scheduler.time += 1
+
+    def stepRest(self, aliveAtStart):
+        # Orden de la lista de coches (orden de insercion)
+        listed = np.flatnonzero(aliveAtStart)
+        listed = listed[np.argsort(self.seq[listed], kind="stable")]
+
+        # Los que llegaron en danger squares ya no estan en la lista
+        listed = listed[self.alive[listed]]
+
+        candidates = ~self.activated[listed]
+        px, py = self.posX[listed], self.posY[listed]
+        isPre = self.preDanger[px, py]
+
+        normal = candidates & ~isPre
+        pre = candidates & isPre
+
+        order = np.concatenate([listed[normal], listed[pre]])
+        if len(order) == 0:
+            return 0
+        rank = np.empty(len(self.agents), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+
+        px, py = self.posX[order], self.posY[order]
+        nx, ny = self.nextX[order], self.nextY[order]
+        arrived = (px == self.destX[order]) & (py == self.destY[order])
+        active = ~arrived
+
+        # Direccion hacia la siguiente celda
+        dx, dy = nx - px, ny - py
+        unit = active & (np.abs(dx) <= 1) & (np.abs(dy) <= 1)
+        codes = np.full(len(order), -1, dtype=np.int8)
+        codes[unit] = _DIRECTION_LOOKUP[(dx[unit] + 1) * 3 + (dy[unit] + 1)]
+
+        isRed = active & self.red[px, py]
+        moving = active & ~isRed
+
+        # Celdas que alguien podria ocupar este tick: su siguiente celda y,
+        # si ya estaba detenido, las celdas de calle para cambiar de carril
+        h = self.height
+        n = len(order)
+        positions = np.arange(n)
+        claimCells = [nx[moving] * h + ny[moving]]
+        claimOwners = [positions[moving]]
+        laneable = moving & (self.timeStopped[order] >= 1) & (codes >= 0)
+        canLane = np.zeros(n, dtype=bool)
+        if laneable.any():
+            laneOwners = positions[laneable]
+            lx, ly = px[laneable], py[laneable]
+            ldx, ldy = dx[laneable], dy[laneable]
+            anyRoad = np.zeros(len(lx), dtype=bool)
+            for side in (-1, 1):
+                # Perpendicular a la direccion de movimiento
+                cx = lx + ldx + side * (ldx == 0)
+                cy = ly + ldy + side * (ldy == 0)
+                ok = (cx >= 0) & (cx < self.width) & (cy >= 0) & (cy < h)
+                ok[ok] = self.occupancy.cells[cx[ok], cy[ok]] <= ROAD
+                anyRoad |= ok
+                claimCells.append(cx[ok] * h + cy[ok])
+                claimOwners.append(laneOwners[ok])
+            canLane[laneable] = anyRoad
+        laneClaim = np.repeat([False, True], [len(claimCells[0]), sum(map(len, claimCells[1:]))])
+        claimCells = np.concatenate(claimCells)
+        claimOwners = np.concatenate(claimOwners)
+
+        # Resolvemos con arreglos lo que no depende del orden:
+        #   - se mueve si su celda esta libre (o el de enfrente ya se fue antes que el)
+        #     y nadie mas la pide
+        #   - se queda si el de enfrente no se va antes que el y no puede cambiar de carril
+        indexOf = np.full(len(self.agents), -1, dtype=np.int64)
+        indexOf[order] = positions
+        target = np.where(moving, nx * h + ny, 0)
+        occupant = np.full(n, -1, dtype=np.int64)
+        occupant[moving] = self.occ[nx[moving], ny[moving]]
+        front = np.where(occupant >= 0, indexOf[np.maximum(occupant, 0)], -1)
+        noLane = ~canLane
+
+        UNKNOWN, MOVES, STAYS = 0, 1, 2
+        # Sigue al de enfrente: depende de lo que haga el de enfrente, que actua antes
+        follows = moving & (front >= 0) & (front < positions)
+        free = moving & (occupant < 0)
+        valid = np.ones(len(claimCells), dtype=bool)
+
+        while True:
+            single = np.bincount(claimCells[valid], minlength=self.width * h)[target] == 1
+
+            # Los demas se resuelven solos: llega (se va), en rojo (se queda), celda libre
+            # (se va si nadie mas la pide), o el de enfrente no esta en esta fase o actua
+            # despues y sigue ahi (se queda si no puede cambiar de carril)
+            status = np.full(n, UNKNOWN, dtype=np.int8)
+            status[arrived] = MOVES
+            status[isRed] = STAYS
+            status[free & single] = MOVES
+            status[moving & ~follows & ~free & noLane] = STAYS
+
+            # Un coche que sigue a otro se va si el de enfrente se va y nadie mas pide su
+            # celda, y se queda si el de enfrente se queda y no puede cambiar de carril.
+            # Cada fila se recorre saltando apuntadores (log del largo de la fila):
+            # ptr es el coche mas adelante alcanzado, passMoves / passStays si todos los
+            # de en medio dejan pasar ese resultado
+            ptr = np.where(follows, front, positions)
+            passMoves = ~follows | single
+            passStays = ~follows | noLane
+            while True:
+                nextPtr = ptr[ptr]
+                if (nextPtr == ptr).all():
+                    break
+                passMoves &= passMoves[ptr]
+                passStays &= passStays[ptr]
+                ptr = nextPtr
+            leader = status[ptr]
+            status[follows & (leader == MOVES) & passMoves] = MOVES
+            status[follows & (leader == STAYS) & passStays] = STAYS
+
+            # Los que se quedan no piden ninguna celda y los que se van no cambian de
+            # carril: sin esas celdas, mas coches pueden quedar solos en la suya
+            ownerStatus = status[claimOwners]
+            stillValid = (ownerStatus == UNKNOWN) | ((ownerStatus == MOVES) & ~laneClaim)
+            if stillValid.sum() == valid.sum():
+                break
+            valid = stillValid
+
+        independent = moving & (status == MOVES)
+        blocked = moving & (status == STAYS)
+        conflicted = moving & (status == UNKNOWN)
+
+        self.vacRank[order[independent | arrived]] = positions[independent | arrived]
+
+        # Coches en rojo o bloqueados
+        stopped = isRed | blocked
+        held = order[stopped]
+        self.timeStopped[held] += 1
+        heldCodes = codes[stopped]
+        self.dirCode[held[heldCodes >= 0]] = heldCodes[heldCodes >= 0]
+
+        # Coches que dependen del orden, uno por uno
+        for i in order[conflicted]:
+            self.stepOne(i, rank[i])
+
+        # Coches que se mueven
+        ind = order[independent]
+        indCodes = codes[independent]
+        self.dirCode[ind[indCodes >= 0]] = indCodes[indCodes >= 0]
+        ox, oy = self.posX[ind], self.posY[ind]
+        tx, ty = nx[independent], ny[independent]
+        stay = self.occ[ox, oy] == ind
+        self.occ[ox[stay], oy[stay]] = -1
+        self.occ[tx, ty] = ind
+        self.posX[ind], self.posY[ind] = tx, ty
+        column = self.roadIndex[tx, ty]
+        k = self.nextMove[self.destId[ind], column]
+        cell = np.where(k >= 0, self.moveCells[self.moveStart[column] + np.maximum(k, 0)], -1)
+        self.nextX[ind] = np.where(cell >= 0, cell // h, -1)
+        self.nextY[ind] = np.where(cell >= 0, cell % h, -1)
+        self.timeStopped[ind] = 0
+        self.moved[ind] = True
+
+        self.stepCount[order[active & ~conflicted]] += 1
+
+        # Coches que llegaron
+        for i in order[arrived]:
+            self.arrive(i)
+
+        return len(order)
+
+    def commit(self):
+        # Escribimos a la capa de ocupacion y a la bitacora de cambios; los objetos Car y
+        # el MultiGrid quedan para sync(). Solo los coches que llegaron se recorren uno por uno
+        model = self.model
+        carIds = self.occupancy.carIds
+
+        arrived = self.arrivedSlots
+        movedSlots = np.flatnonzero(self.moved & self.alive)
+        carIds[self.startX[arrived], self.startY[arrived]] = -1
+        carIds[self.startX[movedSlots], self.startY[movedSlots]] = -1
+        carIds[self.posX[movedSlots], self.posY[movedSlots]] = self.ids[movedSlots]
+
+        # Direcciones que cambiaron
+        turned = self.alive & (self.dirCode >= 0) & (self.dirCode != self.writtenCode)
+        self.writtenCode[turned] = self.dirCode[turned]
+        model.changes.carsChanged(self.ids[self.moved & self.alive | turned].tolist())
+        self.stale = True
+
+        for i in arrived:
+            agent = self.agents[i]
+            model.grid.remove_agent(agent)
+            del self.occupancy.cars[agent.unique_id]
+            model.changes.carArrived(agent)
+            model.activeCars -= 1
+            model.arrived += 1
+            model.addStepCount(int(self.stepCount[i]))
+            self.scheduler.remove_car(agent)
+            model.releaseCar(agent)
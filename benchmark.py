@@ -0,0 +1,335 @@
+# Benchmarks de CityModel: construccion del modelo, pasos por segundo a distintas
+# densidades de coches, latencia de rutas (memo frio y caliente) y de los endpoints
+# de agents_server. Los resultados se guardan en JSON para comparar entre commits.
+# Tambien revisa que el modo por lotes de el mismo estado que el modo por coche en
+# cada tick (batch_equivalence) y que el orden por dependencias no detenga el modelo
+# en 2022_base (dependency_runs).
+#
+#   python benchmark.py --out benchmark_results.json
+#   python benchmark.py --quick
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+
+import mesa
+import numpy as np
+
+from model import CityModel
+from occupancy import ROAD
+from routing import RouteTable, ContractedRouteTable, RouteCache
+
+BASE_MAPS = ["2022_base.txt", "2023_base.txt", "2024_base.txt"]
+
+
+def loadLines(path):
+    with open(path) as baseFile:
+        return baseFile.readlines()
+
+
+def syntheticMap(blocks, blockSize=4):
+    """
+    Genera una ciudad cuadriculada de blocks x blocks manzanas con el mismo formato
+    que los mapas base: anillo exterior de dos carriles en sentido antihorario,
+    avenidas de dos carriles con sentidos alternados, semaforos antes de cada
+    cruce y un destino por manzana.
+    """
+    size = 4 + blocks * blockSize + (blocks - 1) * 2
+    g = [["#"] * size for _ in range(size)]
+
+    # Anillo exterior
+    for c in range(size):
+        g[0][c] = g[1][c] = "<"
+        g[size - 2][c] = g[size - 1][c] = ">"
+    for r in range(size - 2):
+        g[r][0] = g[r][1] = "v"
+    for r in range(2, size):
+        g[r][size - 2] = g[r][size - 1] = "^"
+
+    avenues = [2 + blockSize + k * (blockSize + 2) for k in range(blocks - 1)]
+
+    # Avenidas verticales y horizontales (en los cruces queda la horizontal)
+    for k, x in enumerate(avenues):
+        for r in range(2, size - 2):
+            g[r][x] = g[r][x + 1] = "v" if k % 2 == 0 else "^"
+    for k, y in enumerate(avenues):
+        for c in range(2, size - 2):
+            g[y][c] = g[y + 1][c] = "<" if k % 2 == 0 else ">"
+
+    # Semaforos antes de cada cruce
+    for kx, x in enumerate(avenues):
+        for ky, y in enumerate(avenues):
+            row = y - 1 if kx % 2 == 0 else y + 2
+            g[row][x] = g[row][x + 1] = "S"
+            col = x + 2 if ky % 2 == 0 else x - 1
+            g[y][col] = g[y + 1][col] = "s"
+
+    # Un destino por manzana, junto a la calle de su izquierda
+    starts = [2] + [x + 2 for x in avenues]
+    for y in starts:
+        for x in starts:
+            g[y + 1][x] = "D"
+
+    return ["".join(row) + "\n" for row in g]
+
+
+def buildModel(lines, **kwargs):
+    width = len(lines[0]) - 1
+    height = len(lines)
+    return CityModel(width, height, lines, 100, **kwargs)
+
+
+def timeIt(fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchConstruction(name, lines):
+    model = buildModel(lines)
+    firstRoad = next(iter(model.graph))
+
+    def createGraph():
+        model.graph = {}
+        model.createGraph(lines, firstRoad)
+
+    return {
+        "map": name,
+        "width": model.width,
+        "height": model.height,
+        "construct_s": timeIt(lambda: buildModel(lines)),
+        "create_graph_s": timeIt(createGraph),
+        "route_table_s": timeIt(lambda: RouteTable(model.graph, model.destinations, model.width)),
+        "contracted_table_s": timeIt(
+            lambda: ContractedRouteTable(model.graph, model.destinations, model.width)
+        ),
+        "contracted_nodes": len(ContractedRouteTable(model.graph, model.destinations, model.width).index),
+    }
+
+
+def addCars(model, density, rng):
+    # Llena una fraccion de las celdas de calle libres con coches
+    roads = [
+        pos for pos in model.graph
+        if model.occupancy.cells[pos] == ROAD and not model.occupancy.hasCar(pos)
+    ]
+    rng.shuffle(roads)
+    for pos in roads[: int(len(roads) * density)]:
+        car = model.newCar(pos)
+        if car.nextMove is None:  # Sin ruta a su destino desde aqui
+            model.activeCars -= 1
+            model.releaseCar(car)
+            continue
+        model.schedule.add_car(car)
+        model.placeCar(car, pos)
+
+
+def benchSteps(name, lines, density, steps, batch):
+    random.seed(0)
+    model = buildModel(lines, batch=batch, seed=0)
+    addCars(model, density, random.Random(0))
+    cars = len(model.schedule.cars)
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        model.step()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "map": name,
+        "density": density,
+        "batch": batch,
+        "cars_start": cars,
+        "steps": steps,
+        "steps_per_s": steps / elapsed,
+        "arrived": model.arrived,
+    }
+
+
+def carStates(model):
+    # Lo que debe coincidir entre los dos modos despues de cada tick
+    if model.schedule.engine is not None:
+        model.schedule.engine.sync()
+    cars = sorted(
+        (c.unique_id, c.pos, c.nextMove, c.directionWritten, c.timeStopped, c.stepCount)
+        for c in model.schedule.cars
+    )
+    return cars, model.arrived, model.memo.hits, model.memo.misses, model.occupancy.carIds.tobytes()
+
+
+def checkBatch(name, lines, density, steps):
+    """
+    Corre el mismo modelo por coche y por lotes y compara el estado de los coches
+    tick por tick. Regresa el primer tick distinto (None si todos coinciden).
+    """
+    models = []
+    for batch in (False, True):
+        random.seed(0)
+        model = buildModel(lines, batch=batch, seed=0)
+        addCars(model, density, random.Random(0))
+        models.append(model)
+    perAgent, batched = models
+
+    mismatch = None
+    for step in range(steps):
+        if not perAgent.running:
+            break
+        perAgent.step()
+        batched.step()
+        if carStates(perAgent) != carStates(batched) or perAgent.running != batched.running:
+            mismatch = step
+            break
+    return {"map": name, "density": density, "steps": step + 1, "mismatch": mismatch}
+
+
+def checkDependency(name, lines, seed, steps):
+    """
+    Corre el modelo con ordering="dependency" y la semilla dada. Regresa el step en
+    que se detuvo por tener las cuatro esquinas ocupadas (None si llego a steps).
+    """
+    model = buildModel(lines, seed=seed, ordering="dependency")
+    step = 0
+    while step < steps and model.running:
+        model.step()
+        step += 1
+    halted = None if model.running else step
+    return {"map": name, "seed": seed, "steps": step, "arrived": model.arrived, "halted": halted}
+
+
+def benchRoutes(name, lines, queries=20000):
+    model = buildModel(lines)
+    rng = random.Random(0)
+    cells = list(model.graph)
+    pairs = [(rng.choice(cells), rng.choice(model.destinations)) for _ in range(queries)]
+
+    memo = RouteCache(model.routes, maxSize=len(cells) * len(model.destinations))
+    start = time.perf_counter()
+    for cell, dest in pairs:
+        memo.get(cell, dest)
+    cold = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for cell, dest in pairs:
+        memo.get(cell, dest)
+    warm = time.perf_counter() - start
+
+    return {
+        "map": name,
+        "queries": queries,
+        "cold_us": cold / queries * 1e6,
+        "warm_us": warm / queries * 1e6,
+        "memo_entries": len(memo),
+    }
+
+
+def benchEndpoints(requests=50):
+    try:
+        import agents_server
+    except ImportError as e:
+        return {"skipped": str(e)}
+
+    client = agents_server.app.test_client()
+    results = {}
+
+    def measure(name, call, n):
+        samples = []
+        for _ in range(n):
+            start = time.perf_counter()
+            call()
+            samples.append((time.perf_counter() - start) * 1000)
+        samples.sort()
+        results[name] = {
+            "mean_ms": statistics.mean(samples),
+            "p50_ms": samples[len(samples) // 2],
+            "p95_ms": samples[int(len(samples) * 0.95) - 1],
+        }
+
+    # /updateDelta manda el seq de la respuesta anterior, como el cliente, para medir
+    # los deltas y no el estado completo (solo la primera peticion es completa)
+    seq = [-1]
+
+    def updateDelta():
+        seq[0] = client.get(f"/updateDelta?since={seq[0]}").get_json()["seq"]
+
+    random.seed(0)
+    measure("/init", lambda: client.post("/init"), 5)
+    measure("/update", lambda: client.get("/update"), requests)
+    measure("/updateDelta", updateDelta, requests)
+    measure("/updateBinary", lambda: client.get("/updateBinary"), requests)
+    for route in ["/getCars", "/getBuildings", "/getRoads", "/getTrafficLights"]:
+        measure(route, lambda route=route: client.get(route), requests)
+    return results
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de CityModel.")
+    parser.add_argument("--out", default="benchmark_results.json")
+    parser.add_argument("--quick", action="store_true", help="Menos mapas y pasos")
+    parser.add_argument("--steps", type=int, default=200)
+    args = parser.parse_args()
+
+    maps = [(path, loadLines(path)) for path in BASE_MAPS]
+    sizes = [4] if args.quick else [4, 10, 20]
+    maps += [(f"synthetic_{n}x{n}", syntheticMap(n)) for n in sizes]
+    densities = [0.05] if args.quick else [0.05, 0.15, 0.3]
+    steps = 20 if args.quick else args.steps
+
+    results = {
+        "commit": gitCommit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "mesa": mesa.__version__,
+        "numpy": np.__version__,
+        "construction": [],
+        "steps": [],
+        "routes": [],
+        "batch_equivalence": [],
+        "dependency_runs": [],
+    }
+
+    for name, lines in maps:
+        print("map", name)
+        results["construction"].append(benchConstruction(name, lines))
+        results["routes"].append(benchRoutes(name, lines))
+        for density in densities:
+            for batch in (False, True):
+                results["steps"].append(benchSteps(name, lines, density, steps, batch))
+            check = checkBatch(name, lines, density, steps)
+            if check["mismatch"] is not None:
+                print("batch mode differs from per-agent mode at step", check["mismatch"])
+            results["batch_equivalence"].append(check)
+
+    # En 2022_base el orden por dependencias se detenia antes del step 600 con las
+    # semillas 0 a 15 (la semilla 1 en el step 34)
+    print("dependency ordering")
+    lines = loadLines("2022_base.txt")
+    for seed in (0, 1, 2):
+        run = checkDependency("2022_base.txt", lines, seed, 800)
+        if run["halted"] is not None:
+            print("dependency ordering halted at step", run["halted"], "with seed", seed)
+        results["dependency_runs"].append(run)
+
+    print("endpoints")
+    results["endpoints"] = benchEndpoints(10 if args.quick else 50)
+
+    with open(args.out, "w") as json_file:
+        json.dump(results, json_file, indent=4)
+    print("saved", args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+from collections import deque
+
+
+class ChangeLog:
+    """
+    Bitacora de cambios por step para mandar solo deltas al frontend.
+    Cada step guarda que coches cambiaron (aparecieron, se movieron o giraron),
+    cuales llegaron y que semaforos cambiaron de estado. Se guardan los ultimos
+    `history` steps; si un cliente se queda mas atras se le manda todo.
+    """
+
+    def __init__(self, history=64):
+        self.history = deque(maxlen=history)
+        self.step = 0
+        self.cars = set()
+        self.arrived = set()
+        self.lights = set()
+
+    def carChanged(self, car):
+        self.cars.add(car.unique_id)
+
+    def carsChanged(self, carIds):
+        self.cars.update(carIds)
+
+    def carArrived(self, car):
+        self.cars.discard(car.unique_id)
+        self.arrived.add(car.unique_id)
+
+    def lightChanged(self, light):
+        self.lights.add(light.unique_id)
+
+    def endStep(self, step):
+        # Cerramos el step actual y empezamos uno nuevo
+        self.history.append((step, self.cars, self.arrived, self.lights))
+        self.step = step
+        self.cars = set()
+        self.arrived = set()
+        self.lights = set()
+
+    def reset(self, step):
+        # El modelo se restauro (ver CityModel.restore): los clientes deben pedir todo
+        self.history.clear()
+        self.step = step
+        self.cars = set()
+        self.arrived = set()
+        self.lights = set()
+
+    def since(self, step):
+        """
+        Junta los cambios despues de `step`.
+        Regresa (cars, arrived, lights) con ids, o None si ya no hay historial suficiente
+        (o el cliente va adelante, despues de restaurar un estado anterior).
+        """
+        if step > self.step:
+            return None
+        if step == self.step:
+            return set(), set(), set()
+        if not self.history or self.history[0][0] > step + 1:
+            return None
+
+        cars, arrived, lights = set(), set(), set()
+        for recorded, stepCars, stepArrived, stepLights in self.history:
+            if recorded <= step:
+                continue
+            cars |= stepCars
+            cars -= stepArrived
+            arrived |= stepArrived
+            lights |= stepLights
+
+        return cars, arrived, lights
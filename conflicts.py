@@ -0,0 +1,84 @@
+def laneDirection(graph, cell):
+    # La direccion de un carril es su primer movimiento en el grafo (seguir derecho)
+    moves = graph.get(cell)
+    if not moves:
+        return None
+    return (moves[0][0] - cell[0], moves[0][1] - cell[1])
+
+
+def lineCells(cells, start, direction):
+    # Celdas de calle (o destino) a partir de start, sin incluirla, en linea recta
+    line = []
+    cur = (start[0] + direction[0], start[1] + direction[1])
+    while cur in cells:
+        line.append(cur)
+        cur = (cur[0] + direction[0], cur[1] + direction[1])
+    return line
+
+
+def findConflictZones(graph):
+    """
+    Encuentra los puntos de conflicto del grafo en cualquier mapa.
+    Un punto de conflicto es una celda que recibe coches de dos direcciones distintas
+    (por ejemplo, una calle a la que se puede dar vuelta desde otra). Cada celda
+    desde la que se da vuelta hacia ella es un danger square, salvo si su carril da
+    la vuelta en la siguiente celda (la esquina de una calle): ahi el coche dobla de
+    todos modos y no hay incorporacion que proteger.
+    Regresa:
+        danger_squares: set de celdas
+        danger_squares_info: por danger square,
+            "direction": direccion de su carril
+            "turns": direcciones de las vueltas hacia puntos de conflicto
+            "front": celdas enfrente (en su carril), en orden
+            "turnCells": por cada vuelta, las celdas en esa direccion, en orden
+        pre_danger_squares: la celda antes de cada danger square
+    """
+    feeders = {}
+    for cell, moves in graph.items():
+        for move in moves:
+            feeders.setdefault(move, []).append(cell)
+    cells = set(graph) | set(feeders)
+
+    danger_squares = set()
+    danger_squares_info = {}
+    for target, sources in feeders.items():
+        targetDirection = laneDirection(graph, target)
+        if targetDirection is None:  # Destinos
+            continue
+        directions = {laneDirection(graph, s) for s in sources}
+        if len(directions) < 2:
+            continue
+
+        for source in sources:
+            direction = laneDirection(graph, source)
+            if direction == targetDirection or graph[source][0] == target:
+                continue
+            front = lineCells(cells, source, direction)
+            if len(front) < 2:
+                # Esquina de la calle. Marcarla deja al coche de atras (pre danger) al
+                # final del orden junto a las esquinas donde entran los coches, y las
+                # cuatro esquinas se quedan bloqueadas
+                continue
+            turn = (target[0] - source[0], target[1] - source[1])
+            info = danger_squares_info.setdefault(
+                source,
+                {
+                    "direction": direction,
+                    "turns": [],
+                    "front": front,
+                    "turnCells": [],
+                },
+            )
+            if turn not in info["turns"]:
+                info["turns"].append(turn)
+                info["turnCells"].append(lineCells(cells, source, turn))
+            danger_squares.add(source)
+
+    pre_danger_squares = set()
+    for square in danger_squares:
+        direction = danger_squares_info[square]["direction"]
+        pre_danger = (square[0] - direction[0], square[1] - direction[1])
+        if pre_danger not in danger_squares:
+            pre_danger_squares.add(pre_danger)
+
+    return danger_squares, danger_squares_info, pre_danger_squares
@@ -0,0 +1,194 @@
+# Demanda de coches configurable: origenes arbitrarios, matriz origen-destino (OD),
+# tasa de llegadas que cambia con el tiempo (Poisson) o llegadas de un archivo, y
+# una fila de espera por origen en lugar de parar el modelo cuando no caben.
+#
+#   CityModel(..., demand={"origins": [[0, 0], [27, 27]], "rate": 0.8})
+#   CityModel(..., demand={"origins": [...], "od": [[0.1, 0.0, ...], ...],
+#                          "profile": [[0, 1.0], [500, 2.5], [1000, 1.0]]})
+#   CityModel(..., demand={"origins": [...], "trace": "arrivals.csv"})
+#
+# od[o][d] son coches por step del origen o al destino d (en el orden de
+# model.destinations). El archivo de llegadas tiene lineas "step,origen[,destino]"
+# con indices; sin destino (o -1) se elige con la fila del origen en la OD.
+# step es model.schedule.steps despues del step en que llegan (1 en el primero).
+
+import csv
+import math
+from collections import deque
+
+# Arriba de esta tasa el numero de llegadas se aproxima con una normal
+POISSON_NORMAL_RATE = 30.0
+
+
+class AliasTable:
+    """Muestreo de un indice con pesos dados en O(1) (metodo alias de Vose)."""
+
+    def __init__(self, weights):
+        n = len(weights)
+        total = sum(weights)
+        if n == 0 or total <= 0:
+            raise ValueError("AliasTable needs at least one positive weight")
+        scaled = [w * n / total for w in weights]
+        self.prob = [0.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            (small if scaled[l] < 1 else large).append(l)
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def sample(self, rng):
+        u = rng.random() * len(self.prob)
+        i = int(u)
+        return i if u - i < self.prob[i] else self.alias[i]
+
+
+def poisson(rng, rate):
+    if rate <= 0:
+        return 0
+    if rate > POISSON_NORMAL_RATE:
+        return max(0, round(rng.gauss(rate, math.sqrt(rate))))
+    # Knuth: se multiplican uniformes hasta bajar de e^-rate
+    limit = math.exp(-rate)
+    k = 0
+    p = rng.random()
+    while p > limit:
+        k += 1
+        p *= rng.random()
+    return k
+
+
+def readTrace(path):
+    """Lee las llegadas de un archivo: {step: [(origen, destino o -1), ...]}."""
+    arrivals = {}
+    with open(path, newline="") as traceFile:
+        for row in csv.reader(traceFile):
+            if not row or row[0].strip().startswith("#") or not row[0].strip().lstrip("-").isdigit():
+                continue  # Comentarios y encabezado
+            step, origin = int(row[0]), int(row[1])
+            destination = int(row[2]) if len(row) > 2 and row[2].strip() else -1
+            arrivals.setdefault(step, []).append((origin, destination))
+    return arrivals
+
+
+class Demand:
+    """
+    Genera los coches que quieren entrar cada step y los agrega cuando su origen
+    esta libre. Los que no caben esperan en la fila de su origen (backlog), en orden.
+    Cada llegada elige origen y destino con tablas alias (O(1) por coche).
+    """
+
+    def __init__(self, model, origins=None, od=None, rate=None, profile=None, trace=None):
+        self.model = model
+        if origins is None:
+            origins = model.starting_positions
+        self.origins = [tuple(o) for o in origins]
+        destinations = model.destinations
+        routes = model.routes
+
+        for origin in self.origins:
+            if origin not in model.graph:
+                raise ValueError(f"Demand origin {origin} is not a road cell")
+
+        # Matriz OD: sin matriz, todos los destinos alcanzables con el mismo peso
+        if od is None:
+            od = [
+                [1.0 if routes.distance(o, d) is not None else 0.0 for d in destinations]
+                for o in self.origins
+            ]
+            if rate is None:
+                rate = 1.0
+        if len(od) != len(self.origins) or any(len(row) != len(destinations) for row in od):
+            raise ValueError(
+                f"OD matrix must be {len(self.origins)} x {len(destinations)} (origins x destinations)"
+            )
+        for o, row in zip(self.origins, od):
+            for d, weight in zip(destinations, row):
+                if weight < 0:
+                    raise ValueError("OD matrix entries must be non-negative")
+                if weight > 0 and routes.distance(o, d) is None:
+                    raise ValueError(f"No route from origin {o} to destination {d}")
+
+        rowTotals = [sum(row) for row in od]
+        self.totalRate = sum(rowTotals) if rate is None else rate
+        self.originTable = AliasTable(rowTotals) if sum(rowTotals) > 0 else None
+        self.destinationTables = [AliasTable(row) if sum(row) > 0 else None for row in od]
+
+        # Multiplicador de la tasa por tramos: [(step desde el que aplica, factor)]
+        self.profile = sorted((int(s), float(f)) for s, f in profile) if profile else [(0, 1.0)]
+        self.trace = readTrace(trace) if trace is not None else None
+        if self.trace is not None:
+            for o, d in (a for arrivals in self.trace.values() for a in arrivals):
+                if not 0 <= o < len(self.origins) or d >= len(destinations):
+                    raise ValueError(f"Trace arrival ({o}, {d}) is out of range")
+
+        self.backlogs = [deque() for _ in self.origins]  # Destinos esperando por origen
+        self.waiting = {}  # Indices de origen con fila, en orden de llegada
+        self.spawned = 0
+        self.generated = 0
+
+    def factor(self, step):
+        current = 0.0
+        for start, f in self.profile:
+            if start > step:
+                break
+            current = f
+        return current
+
+    def destinationFor(self, origin, rng):
+        table = self.destinationTables[origin]
+        if table is None:
+            raise ValueError(f"Demand origin {self.origins[origin]} has no destinations in the OD matrix")
+        return table.sample(rng)
+
+    def arrivals(self, step):
+        # Llegadas de este step: (origen, destino) como indices
+        rng = self.model.random
+        if self.trace is not None:
+            return [
+                (o, d if d >= 0 else self.destinationFor(o, rng))
+                for o, d in self.trace.get(step, ())
+            ]
+        if self.originTable is None:
+            return []
+        count = poisson(rng, self.totalRate * self.factor(step))
+        result = []
+        for _ in range(count):
+            o = self.originTable.sample(rng)
+            result.append((o, self.destinationFor(o, rng)))
+        return result
+
+    def step(self, step):
+        for o, d in self.arrivals(step):
+            self.backlogs[o].append(d)
+            self.waiting[o] = True
+            self.generated += 1
+
+        model = self.model
+        destinations = model.destinations
+        for o in list(self.waiting):
+            pos = self.origins[o]
+            if not model.hasNoCars(pos):
+                continue
+            car = model.newCar(pos, destinations[self.backlogs[o].popleft()])
+            model.schedule.add_car(car)
+            model.placeCar(car, pos)
+            self.spawned += 1
+            if not self.backlogs[o]:
+                del self.waiting[o]
+
+    def backlog(self):
+        return self.generated - self.spawned
+
+    def getState(self):
+        return ([list(b) for b in self.backlogs], list(self.waiting), self.spawned, self.generated)
+
+    def setState(self, state):
+        backlogs, waiting, self.spawned, self.generated = state
+        self.backlogs = [deque(b) for b in backlogs]
+        self.waiting = dict.fromkeys(waiting, True)
@@ -708,15 +708,84 @@ async function getRoads() {
 }
 
 
+// Ultimo step que recibimos del servidor, para pedir solo los cambios
+let lastSeq = -1;
+
+// Usar el endpoint binario (updateBinary) en lugar de JSON, conviene con muchos coches
+const useBinaryUpdates = false;
+const directionNames = ["up", "down", "right", "left"];
+
+async function updateBinary() {
+    try {
+        let response = await fetch(agent_server_uri + "updateBinary")
+
+        if (response.ok) {
+            // Leer el frame directo a typed arrays (ver packState en agents_server.py)
+            const buffer = await response.arrayBuffer();
+            const [step, numCars, numLights] = new Uint32Array(buffer, 0, 3);
+            let offset = 12;
+            const ids = new Int32Array(buffer, offset, numCars);
+            offset += 4 * numCars;
+            const xs = new Uint16Array(buffer, offset, numCars);
+            offset += 2 * numCars;
+            const zs = new Uint16Array(buffer, offset, numCars);
+            offset += 2 * numCars;
+            const directions = new Uint8Array(buffer, offset, numCars);
+            offset += numCars;
+            const lightBits = new Uint8Array(buffer, offset, Math.ceil(numLights / 8));
+            lastSeq = step;
+
+            // Actualizar los agentes (carros)
+            const agentsById = new Map(agents.map(agent => [agent.id, agent]));
+            const newAgentIds = new Set();
+            for (let i = 0; i < numCars; i++) {
+                const id = String(ids[i]);
+                const newTargetPosition = [xs[i] + 0.5, 1 - 0.88, data.height - zs[i] - 0.5];
+                newAgentIds.add(id);
+
+                const existingAgent = agentsById.get(id);
+                if (existingAgent) {
+                    existingAgent.initialPosition = existingAgent.position.slice();
+                    existingAgent.targetPosition = newTargetPosition;
+                    existingAgent.elapsedTime = 0;
+                    existingAgent.progress = 0;
+                    existingAgent.direction = directionNames[directions[i]];
+                } else {
+                    const newAgent = new Object3D(id, newTargetPosition, [0, 0, 0], [0.5, 0.5, 0.5]);
+                    newAgent.direction = directionNames[directions[i]];
+                    newAgent.color = [Math.random(), Math.random(), Math.random(), 1.0];
+                    agents.push(newAgent);
+                }
+            }
+
+            // Eliminar agentes que ya no están presentes
+            for (let i = agents.length - 1; i >= 0; i--) {
+                if (!newAgentIds.has(agents[i].id)) {
+                    agents.splice(i, 1);
+                }
+            }
+
+            // Semáforos, en el mismo orden que getTrafficLights
+            for (let i = 0; i < numLights && i < trafficLights.length; i++) {
+                trafficLights[i].go = ((lightBits[i >> 3] >> (i & 7)) & 1) == 1;
+            }
+        }
+
+    } catch (error) {
+        console.log(error)
+    }
+}
+
 async function update() {
     try {
-        // Enviar una solicitud al servidor para actualizar el modelo y obtener datos
-        let response = await fetch(agent_server_uri + "update")
+        // Enviar una solicitud al servidor para actualizar el modelo y obtener solo los cambios
+        let response = await fetch(agent_server_uri + "updateDelta?since=" + lastSeq)
 
         // Verificar si la respuesta fue exitosa
         if (response.ok) {
             // Parsear la respuesta JSON
             let result = await response.json();
+            lastSeq = result.seq;
 
             // Actualizar los agentes (carros)
             const carData = result.cars;
@@ -758,9 +827,10 @@ async function update() {
                 }
             }
 
-            // Eliminar agentes que ya no están presentes
+            // Eliminar agentes que ya no están presentes (o que llegaron a su destino)
+            const arrivedIds = new Set(result.arrived);
             for (let i = agents.length - 1; i >= 0; i--) {
-                if (!newAgentIds.includes(agents[i].id)) {
+                if (result.full ? !newAgentIds.includes(agents[i].id) : arrivedIds.has(agents[i].id)) {
                     agents.splice(i, 1);
                 }
             }
@@ -789,8 +859,8 @@ async function update() {
                 }
             }
 
-            // Eliminar semáforos que ya no están presentes
-            for (let i = trafficLights.length - 1; i >= 0; i--) {
+            // Eliminar semáforos que ya no están presentes (solo con el estado completo)
+            for (let i = trafficLights.length - 1; i >= 0 && result.full; i--) {
                 if (!newLightIds.includes(trafficLights[i].id)) {
                     trafficLights.splice(i, 1);
                 }
@@ -865,7 +935,7 @@ async function drawScene(gl, programInfo, agentsVao, agentsBufferInfo, buildings
     // Update the scene every 30 frames
     if (frameCount % 10 == 0) {
         frameCount = 0
-        await update()
+        await (useBinaryUpdates ? updateBinary() : update())
     }
 
     // Request the next frame
@@ -0,0 +1,174 @@
+from collections import deque
+import numpy as np
+
+# Steps detenido para que un coche empiece una cadena de espera (mas que un ciclo de semaforo)
+MIN_STOPPED = 20
+# Coches sacados del grid a la vez, y steps que uno puede esperar fuera antes de salir de la corrida
+MAX_PARKED = 16
+MAX_PARKED_STEPS = 100
+
+
+class GridlockDetector:
+    """
+    Detecta ciclos de espera (gridlock): un coche espera al coche que ocupa su
+    siguiente celda y, si la cadena se cierra, ninguno se puede volver a mover.
+    Las cadenas empiezan en coches detenidos al menos minStopped steps (los demas se
+    movieron hace poco), pero siguen por cualquier coche. Cada coche espera a lo mas
+    a uno y se visita una vez, asi que cada step es lineal en los coches; no es
+    incremental, los detenidos se buscan de nuevo cada step.
+    Con recover=True cada ciclo se rompe: un coche del ciclo toma otra celda libre
+    del grafo (Car.ChangeRoute) o, si ninguno puede, el mas viejo sale del grid y
+    vuelve en la primera celda libre de su ruta (ver unpark). A lo mas maxParked
+    coches esperan fuera; el que lleva mas de maxParkedSteps (o el mas viejo, si
+    hace falta lugar) sale de la corrida sin llegar (dropped).
+    """
+
+    def __init__(self, model, recover=False, minStopped=MIN_STOPPED, maxParked=MAX_PARKED, maxParkedSteps=MAX_PARKED_STEPS):
+        self.model = model
+        self.recover = recover
+        self.minStopped = minStopped
+        self.maxParked = maxParked
+        self.maxParkedSteps = maxParkedSteps
+        self.cycles = []  # Ciclos encontrados en el ultimo step
+        self.known = set()  # Ids de los ciclos del ultimo step, para contar cada uno una vez
+        self.parked = deque()  # (coche, step en que salio) sacados del grid para romper un ciclo
+
+        # Estadisticas
+        self.detected = 0
+        self.reroutes = 0
+        self.removals = 0
+        self.dropped = 0
+
+    def stoppedCars(self):
+        engine = self.model.schedule.engine
+        if engine is not None:  # En modo por lotes timeStopped vive en los arreglos
+            slots = np.flatnonzero(engine.alive & (engine.timeStopped >= self.minStopped))
+            slots = slots[np.argsort(engine.seq[slots], kind="stable")]  # En el orden del scheduler
+            if len(slots):
+                engine.sync()  # findCycles lee la posicion y la siguiente celda de los Car
+            return [engine.agents[i] for i in slots]
+        return [car for car in self.model.schedule.cars if car.timeStopped >= self.minStopped]
+
+    def blocker(self, car):
+        # El coche en la siguiente celda de car, o None si no espera a nadie
+        if car.nextMove is None or car.position == car.destination:
+            return None
+        return self.model.occupancy.carAt(car.nextMove)
+
+    def findCycles(self):
+        cycles = []
+        seen = {}  # coche -> 1 en la cadena actual, 2 ya revisado
+        for car in self.stoppedCars():
+            chain = []
+            cur = car
+            while cur is not None and cur not in seen:
+                seen[cur] = 1
+                chain.append(cur)
+                cur = self.blocker(cur)
+            if cur is not None and seen[cur] == 1:  # La cadena se cerro en cur
+                cycles.append(chain[chain.index(cur):])
+            for c in chain:
+                seen[c] = 2
+        return cycles
+
+    def step(self):
+        self.unpark()
+        self.cycles = self.findCycles()
+        current = set()
+        for cycle in self.cycles:
+            key = frozenset(car.unique_id for car in cycle)
+            current.add(key)
+            if key not in self.known:
+                self.detected += 1
+            if self.recover:
+                self.breakCycle(cycle)
+        self.known = current
+
+    def gridlockedCars(self):
+        return sum(len(cycle) for cycle in self.cycles)
+
+    def breakCycle(self, cycle):
+        model = self.model
+        occupancy = model.occupancy
+        for car in cycle:
+            for move in model.graph.get(car.position, ()):
+                if (
+                    move != car.nextMove
+                    and not occupancy.hasCar(move)
+                    and model.routes.distance(move, car.destination) is not None
+                ):
+                    car.ChangeRoute(move)
+                    engine = model.schedule.engine
+                    if engine is not None:
+                        engine.setNext(engine.slots[car.unique_id], move)
+                    self.reroutes += 1
+                    return
+
+        # Nadie puede cambiar de celda: sale el coche mas viejo del ciclo
+        self.park(min(cycle, key=model.schedule.cars.order))
+
+    def park(self, car):
+        model = self.model
+        schedule = model.schedule
+        if schedule.engine is not None:
+            schedule.engine.sync()
+        if car.waiting:
+            schedule.waiting.pop(car.position, None)
+            car.waiting = False
+        model.removeCar(car)
+        schedule.remove_car(car)
+        if len(self.parked) >= self.maxParked:
+            self.drop(self.parked.popleft()[0])
+        self.parked.append((car, schedule.steps))
+        self.removals += 1
+
+    def drop(self, car):
+        # El coche no pudo volver: sale de la corrida sin contar como llegada
+        self.model.activeCars -= 1
+        self.model.releaseCar(car)
+        self.dropped += 1
+
+    def unpark(self):
+        # Los coches sacados vuelven (en orden) en su celda o, si esta ocupada, en la
+        # primera celda libre mas adelante en su ruta (se saltan la fila detenida).
+        # Conservan su timeStopped mas los steps que esperaron fuera y su enteredAt
+        model = self.model
+        steps = model.schedule.steps
+        for _ in range(len(self.parked)):
+            car, parkedAt = self.parked.popleft()
+            cell = self.freeCellOnRoute(car)
+            if cell is None:
+                if steps - parkedAt >= self.maxParkedSteps:
+                    self.drop(car)
+                else:
+                    self.parked.append((car, parkedAt))
+                continue
+            if cell != car.position:
+                car.position = cell
+                car.nextMove = car.GetRoute(cell)
+            car.timeStopped += steps - parkedAt
+            model.schedule.add_car(car)
+            model.placeCar(car, cell)
+
+    def freeCellOnRoute(self, car):
+        model = self.model
+        if model.hasNoCars(car.position):
+            return car.position
+        path = model.routes.route(car.position, car.destination) or []
+        for cell in path[:-1]:  # Sin el destino
+            if model.hasNoCars(cell):
+                return cell
+        return None
+
+    def getState(self):
+        return (
+            [(car.getState(), parkedAt) for car, parkedAt in self.parked], set(self.known),
+            self.detected, self.reroutes, self.removals, self.dropped,
+        )
+
+    def setState(self, state, makeCar):
+        # makeCar(estado) regresa un coche con ese estado (ver CityModel.restore)
+        parked, known, self.detected, self.reroutes, self.removals, self.dropped = state
+        self.parked = deque((makeCar(carState), parkedAt) for carState, parkedAt in parked)
+        self.known = set(known)
+        self.cycles = []
@@ -0,0 +1,190 @@
+# Compilador de mapas: convierte un *_base.txt en un artefacto .npz junto al mapa
+# (2024_base.txt -> 2024_base.npz) con todo lo que CityModel calcula del texto:
+# tipos de celda, grafo en CSR (en el mismo orden que createGraph), direcciones de
+# los semaforos, destinos y la tabla de rutas completa (ver RouteTable.toArrays).
+# Con el terreno del artefacto CityModel no recorre el texto, y la tabla de rutas
+# se lee (StoredRouteTable) en lugar de repetir un BFS por destino en cada proceso.
+# Si el texto cambia (hash) o cambia el formato, se vuelve a compilar.
+#
+#   python mapcompiler.py 2022_base.txt 2023_base.txt 2024_base.txt
+#
+# Los .npz no se pueden abrir con mmap (son un zip); se guardan sin comprimir. Sin
+# la tabla de rutas cargarlos toma menos de un milisegundo; la tabla ocupa
+# destinos x celdas de calle (unos 18 MB en un mapa de 122x122 con 400 destinos).
+
+import argparse
+import hashlib
+import os
+import numpy as np
+from model import CityModel
+from routing import RouteTable, ContractedRouteTable, StoredRouteTable
+
+MAP_FORMAT_VERSION = 2
+
+# Mapas ya cargados en este proceso: ruta -> (hash del texto, CompiledMap)
+_loaded = {}
+
+
+class CompiledMap:
+    """
+    Un mapa ya procesado. prebuilt() regresa lo que CityModel acepta como prebuilt,
+    con el terreno para que no recorra el texto; la tabla de rutas viene del
+    artefacto ("table") o se calcula la primera vez, y se comparte entre modelos.
+    """
+
+    def __init__(self, width, height, lines, cells, graph, TLDirections, destinations, routes=None):
+        self.width = width
+        self.height = height
+        self.lines = lines
+        self.cells = cells  # Codigos de occupancy, cells[x, y]
+        self.graph = graph
+        self.TLDirections = TLDirections
+        self.destinations = destinations
+        self.roadDirections, self.lights = _mapLayers(lines)
+        self.routes = dict(routes or {})  # route_index -> tabla de rutas
+
+    def prebuilt(self, route_index="table"):
+        if route_index not in self.routes:
+            tables = {"table": RouteTable, "contracted": ContractedRouteTable}
+            self.routes[route_index] = tables[route_index](self.graph, self.destinations, self.width)
+        return {
+            "graph": self.graph,
+            "TLDirections": self.TLDirections,
+            "routes": self.routes[route_index],
+            "cells": self.cells,
+            "roadDirections": self.roadDirections,
+            "lights": self.lights,
+            "destinations": self.destinations,
+        }
+
+
+def _mapLayers(lines):
+    """
+    Direcciones de las calles y semaforos (posicion, simbolo) desde el texto, en el
+    mismo orden en que CityModel lo recorre. Se hace una vez por mapa, no por modelo.
+    """
+    height = len(lines)
+    roadDirections = {}
+    lights = []
+    for r, row in enumerate(lines):
+        for c, col in enumerate(row):
+            if col in ["v", "^", ">", "<"]:
+                roadDirections[(c, height - r - 1)] = CityModel.mapData[col]
+            elif col in ["S", "s"]:
+                lights.append(((c, height - r - 1), col))
+    return roadDirections, lights
+
+
+def artifactPath(path):
+    return os.path.splitext(path)[0] + ".npz"
+
+
+def _hash(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def compileMap(path, lines=None):
+    """
+    Construye el CompiledMap desde el texto (creando un modelo una vez), calcula la
+    tabla de rutas completa y guarda todo en el artefacto.
+    """
+    if lines is None:
+        with open(path) as baseFile:
+            lines = baseFile.readlines()
+    width = len(lines[0]) - 1
+    height = len(lines)
+
+    model = CityModel(width, height, lines, 2, route_index="contracted")
+    graph = model.graph
+
+    nodes = np.array(list(graph), dtype=np.int32).reshape(-1, 2)
+    indptr = np.zeros(len(graph) + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum([len(moves) for moves in graph.values()])
+    moves = np.array([m for ms in graph.values() for m in ms], dtype=np.int32).reshape(-1, 2)
+    lights = list(model.TLDirections)
+    routes = RouteTable(graph, model.destinations, width)
+
+    np.savez(
+        artifactPath(path),
+        version=np.int32(MAP_FORMAT_VERSION),
+        source_hash=np.array(_hash("".join(lines))),
+        symbols=np.array([[ord(ch) for ch in line[:width]] for line in lines], dtype=np.uint8),
+        cells=model.occupancy.cells,
+        nodes=nodes,
+        indptr=indptr,
+        moves=moves,
+        lights=np.array(lights, dtype=np.int32).reshape(-1, 2),
+        light_directions=np.array([model.TLDirections[p] for p in lights]),
+        destinations=np.array(model.destinations, dtype=np.int32).reshape(-1, 2),
+        **routes.toArrays(height),
+    )
+
+    return CompiledMap(
+        width, height, lines, model.occupancy.cells.copy(), graph,
+        dict(model.TLDirections), list(model.destinations), {"table": routes},
+    )
+
+
+def readArtifact(path, sourceHash):
+    """Lee el artefacto; regresa None si no existe, es de otra version o de otro texto."""
+    try:
+        data = np.load(artifactPath(path))
+    except (OSError, ValueError):
+        return None
+    with data:
+        if int(data["version"]) != MAP_FORMAT_VERSION or str(data["source_hash"]) != sourceHash:
+            return None
+
+        symbols = data["symbols"]
+        height, width = symbols.shape
+        lines = [bytes(row).decode() + "\n" for row in symbols]
+
+        nodes = data["nodes"].tolist()
+        indptr = data["indptr"].tolist()
+        moves = [tuple(m) for m in data["moves"].tolist()]
+        graph = {
+            (x, y): moves[indptr[i]:indptr[i + 1]] for i, (x, y) in enumerate(nodes)
+        }
+        TLDirections = {
+            tuple(p): str(d) for p, d in zip(data["lights"].tolist(), data["light_directions"])
+        }
+        destinations = [tuple(p) for p in data["destinations"].tolist()]
+        cells = data["cells"].copy()
+        routes = StoredRouteTable(
+            graph, destinations, width, {name: data[name] for name in data.files if name.startswith("route_")}
+        )
+
+    return CompiledMap(width, height, lines, cells, graph, TLDirections, destinations, {"table": routes})
+
+
+def loadMap(path):
+    """
+    Regresa el CompiledMap de un mapa de texto. Usa el que ya esta en memoria o el
+    artefacto en disco si el texto no ha cambiado; si no, lo compila.
+    """
+    with open(path) as baseFile:
+        lines = baseFile.readlines()
+    sourceHash = _hash("".join(lines))
+
+    cached = _loaded.get(path)
+    if cached is not None and cached[0] == sourceHash:
+        return cached[1]
+
+    compiled = readArtifact(path, sourceHash)
+    if compiled is None:
+        compiled = compileMap(path, lines)
+    _loaded[path] = (sourceHash, compiled)
+    return compiled
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compila mapas de texto a artefactos .npz.")
+    parser.add_argument("maps", nargs="+")
+    args = parser.parse_args()
+    for path in args.maps:
+        compileMap(path)
+        print("compiled", path, "->", artifactPath(path))
+
+
+if __name__ == "__main__":
+    main()
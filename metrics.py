@@ -0,0 +1,99 @@
+# Metricas por step en disco, por columnas: un archivo binario append-only por
+# columna y un schema.json con los nombres y el dtype de cada una (int64 para los
+# contadores, float64 para lo demas). Los valores se juntan en bloques de
+# chunkSize steps antes de escribirse, asi que la memoria no crece con la corrida.
+# loadMetrics abre cada columna con np.memmap, sin copiarla.
+#
+#   model = CityModel(..., metrics_path="runs/2024_seed0")
+#   ...
+#   model.close()
+#   columns = loadMetrics("runs/2024_seed0")
+#   columns["Arrived"][-1]
+
+import json
+import os
+import numpy as np
+
+DTYPE = "<f8"
+COUNTER_DTYPE = "<i8"
+
+
+def _schemaPath(path):
+    return os.path.join(path, "schema.json")
+
+
+class MetricsSink:
+    """
+    Escribe reporters escalares (con el mismo formato que los del DataCollector)
+    una fila por step. Las columnas en counters se guardan como enteros y las demas
+    como float64. Si el directorio ya tiene metricas con las mismas columnas, se
+    agregan al final.
+    """
+
+    def __init__(self, path, reporters, chunkSize=1024, counters=()):
+        self.path = path
+        self.reporters = reporters
+        self.chunkSize = chunkSize
+        names = list(reporters)
+        schema = {
+            "columns": {
+                name: {"file": f"{i}.bin", "dtype": COUNTER_DTYPE if name in counters else DTYPE}
+                for i, name in enumerate(names)
+            },
+        }
+
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(_schemaPath(path)):
+            with open(_schemaPath(path)) as schemaFile:
+                if json.load(schemaFile) != schema:
+                    raise ValueError(f"Metrics in {path} have different columns")
+        else:
+            with open(_schemaPath(path), "w") as schemaFile:
+                json.dump(schema, schemaFile, indent=4)
+
+        self.files = {
+            name: open(os.path.join(path, column["file"]), "ab")
+            for name, column in schema["columns"].items()
+        }
+        self.buffers = [np.zeros(chunkSize, dtype=column["dtype"]) for column in schema["columns"].values()]
+        self.rows = 0
+
+    def collect(self, model):
+        for buffer, reporter in zip(self.buffers, self.reporters.values()):
+            buffer[self.rows] = reporter(model)
+        self.rows += 1
+        if self.rows == self.chunkSize:
+            self.flush()
+
+    def flush(self):
+        if self.rows == 0:
+            return
+        for buffer, columnFile in zip(self.buffers, self.files.values()):
+            columnFile.write(buffer[: self.rows].tobytes())
+            columnFile.flush()
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        for columnFile in self.files.values():
+            columnFile.close()
+        self.files = {}
+
+
+def loadMetrics(path):
+    """
+    Regresa {columna: arreglo} con las metricas de path, mapeadas desde disco, cada
+    una con el dtype del schema. Si la corrida se corto a medio bloque, todas las
+    columnas se recortan al mismo largo.
+    """
+    with open(_schemaPath(path)) as schemaFile:
+        schema = json.load(schemaFile)
+
+    files = {
+        name: (os.path.join(path, column["file"]), np.dtype(column["dtype"]))
+        for name, column in schema["columns"].items()
+    }
+    rows = min((os.path.getsize(f) // dtype.itemsize for f, dtype in files.values()), default=0)
+    if rows == 0:
+        return {name: np.zeros(0, dtype=dtype) for name, (f, dtype) in files.items()}
+    return {name: np.memmap(f, dtype=dtype, mode="r", shape=(rows,)) for name, (f, dtype) in files.items()}
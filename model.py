@@ -3,13 +3,27 @@ from mesa.time import RandomActivation, BaseScheduler
 from mesa.space import MultiGrid
 from agent import *
 import json
+import pickle
+import time
 from collections import deque
 import pprint
 import mesa
 from CautionScheduler import CautionScheduler 
+from routing import RouteTable, ContractedRouteTable, RouteCache, CongestionRouter
+from occupancy import OccupancyGrid, ROAD, DESTINATION, OBSTACLE
+from changes import ChangeLog
+from signals import buildControllers
+from profiling import PhaseProfiler, SCHEDULER_PHASES, BATCH_PHASES, DEPENDENCY_PHASES
+from tripstats import TripStats
+from metrics import MetricsSink
+from demand import Demand
+from gridlock import GridlockDetector
 import requests
 
 
+SNAPSHOT_VERSION = 2
+
+
 class CityModel(Model):
     #  Atributos de clase
 
@@ -60,7 +74,19 @@ class CityModel(Model):
         ],
     }
 
-    def __init__(self, width, height, lines, steps_dist_max): #Recibimos el mapa como parametros del servidor
+    def __init__(self, width, height, lines, steps_dist_max, memo_size=4096, batch=False, prebuilt=None, seed=None, profile=False, profile_trace=None, ordering="caution", signals="fixed", routing="static", route_index="table", metrics_path=None, demand=None, gridlock="off"): #Recibimos el mapa como parametros del servidor
+        # prebuilt: grafo y tabla de rutas de otro modelo con el mismo mapa (ver getPrebuilt);
+        #   si trae el terreno (cells, roadDirections, lights, destinations, ver mapcompiler) no se recorre el texto
+        # seed: la usa mesa.Model.__new__ para el generador aleatorio
+        # profile / profile_trace: medir las fases del scheduler (y escribirlas a un archivo)
+        # metrics_path: escribir las metricas por step a disco en lugar del DataCollector (ver metrics.py)
+        # demand: origenes, matriz OD y tasa de llegadas de los coches (ver demand.py); sin ella
+        #   se agregan coches en las esquinas y el modelo para cuando no caben
+        # gridlock: "off", "detect" (contar ciclos de espera) o "recover" (y romperlos), ver gridlock.py
+        # ordering: orden de activacion de los coches, "caution" o "dependency"
+        # signals: "fixed" (ciclo de 7 steps) o "adaptive" (controlador por cruce, ver signals.py)
+        # routing: "static" (tabla de rutas) o "congestion" (A* con pesos de trafico, ver CongestionRouter)
+        # route_index: "table" (todas las celdas) o "contracted" (solo cruces, para mapas grandes)
 
        
         super().__init__()
@@ -71,31 +97,91 @@ class CityModel(Model):
         self.width = width
         self.height = height
         self.grid = MultiGrid(self.width, self.height, torus=False)
+        self.occupancy = OccupancyGrid(self.width, self.height) # Tipos de celda y coches en arreglos
+        self.roadDirections = {} # posicion -> direccion de la calle (tambien debajo de los semaforos)
+        self.staticCells = None # Agentes de terreno, solo si se piden (ver staticAgents)
+        self.changes = ChangeLog() # Cambios por step para el endpoint de deltas
         # self.schedule = BaseScheduler(self)
         self.activeCars = 0
-        self.memoCount = 0
-        self.noMemoCount = 0
         self.arrived = 0
+        self.carPool = [] # Coches que ya llegaron, para reusarlos (ver newCar)
+
+        # Distribucion de la duracion de los viajes (un histograma, no un reporter por bucket)
+        self.tripStats = TripStats(steps_dist_max)
+
+        # Medicion por fase del scheduler, solo si se pide
+        self.profiler = None
+        profile_reporters = {}
+        if profile or profile_trace:
+            phases = BATCH_PHASES if batch else SCHEDULER_PHASES
+            if ordering == "dependency":
+                phases = DEPENDENCY_PHASES
+            self.profiler = PhaseProfiler(phases, profile_trace)
+            profile_reporters = self.profiler.reporters()
+
+        routing_reporters = {}
+        # Memoization / No Memoization (la grafica de pie de server.py) cuentan el cache
+        # de rutas que usan los coches; con rutas por congestion los coches no pasan
+        # por self.memo y el cache es el de los planes del router (reusar un plan
+        # contra correr A*). El router no desaloja planes: los tira al cambiar de epoca
+        memo_reporters = {
+            "Memoization": lambda m: self.memo.hits,
+            "No Memoization": lambda m: self.memo.misses,
+            "Memo Evictions": lambda m: self.memo.evictions,
+        }
+        if routing == "congestion":
+            routing_reporters = {
+                "Plan Hits": lambda m: self.router.hits,
+                "Plan Misses": lambda m: self.router.misses,
+                "Replans": lambda m: self.router.replans,
+            }
+            memo_reporters = {
+                "Memoization": lambda m: self.router.hits,
+                "No Memoization": lambda m: self.router.misses,
+            }
 
-        self.steps_distribution_lambda = {}
-        self.steps_distribution = {}
+        demand_reporters = {}
+        if demand is not None:
+            demand_reporters = {
+                "Backlog": lambda m: self.demand.backlog(),
+                "Spawned": lambda m: self.demand.spawned,
+            }
 
-        # Logica de gráfica de distribucion
-        for i in range(1, steps_dist_max):
-            self.steps_distribution[i] = 0
-            self.steps_distribution_lambda[str(i)] = (
-                lambda m, i=i: self.steps_distribution[i]
-            )
+        gridlock_reporters = {}
+        if gridlock != "off":
+            gridlock_reporters = {
+                "Gridlocks": lambda m: self.gridlock.detected,
+                "Gridlocked Cars": lambda m: self.gridlock.gridlockedCars(),
+                "Gridlock Reroutes": lambda m: self.gridlock.reroutes,
+                "Parked Cars": lambda m: len(self.gridlock.parked),
+                "Dropped Cars": lambda m: self.gridlock.dropped,
+            }
 
-        self.datacollector = mesa.DataCollector(
-            self.steps_distribution_lambda
+        self.stepTime = 0.0
+        reporters = (
+            self.tripStats.reporters()
+            | profile_reporters
+            | routing_reporters
+            | demand_reporters
+            | gridlock_reporters
+            | {"ActiveCars": lambda m: self.activeCars}
+            | memo_reporters
             | {
-                "ActiveCars": lambda m: self.activeCars,
-                "Memoization": lambda m: self.memoCount,
-                "No Memoization": lambda m: self.noMemoCount,
-                "Arrived": lambda m: self.arrived
+                "Arrived": lambda m: self.arrived,
+                "Step ms": lambda m: self.stepTime * 1000,
             }
         )
+        self.datacollector = mesa.DataCollector(reporters)
+
+        # Con metrics_path las metricas van a disco y el DataCollector se queda vacio,
+        # para que la memoria no crezca en corridas largas
+        self.metrics = None
+        if metrics_path is not None:
+            scalars = {name: r for name, r in reporters.items() if name != "Trips"}
+            counters = set(routing_reporters) | set(demand_reporters) | set(gridlock_reporters) | set(memo_reporters) | {
+                "ActiveCars", "Arrived",
+            }
+            self.metrics = MetricsSink(metrics_path, scalars, counters=counters)
 
         # Las esquinas, donde se agregan coches
         self.starting_positions = [
@@ -103,89 +189,99 @@ class CityModel(Model):
         ]
 
         self.graph = {}
-        self.memo = {}
         graphCreated = False
         self.TLDirections = {}
-        traffic_lights = []
-        for r, row in enumerate(lines):
-            for c, col in enumerate(row):
-                if col in ["v", "^", ">", "<"]:
-                    agent = Road(
-                        self.unique_id,
-                        self,
-                        (c, self.height - r - 1),
-                        CityModel.mapData[col],
-                    )
-                    self.unique_id += 1
-                    self.grid.place_agent(agent, (c, self.height - r - 1))
-
-                    if not graphCreated: #Creamos el grafo al encontrar el primer Road en el mapa
-                        p = (c, self.height - r - 1)
-                        self.createGraph(lines, (c, self.height - r - 1))
-                        graphCreated = True
-
-
-                elif col in ["S", "s"]: # Semáforos
-                    cycle = 7
-                    
-                    start = True if col == "S" else False
-                    agent = Traffic_Light(
-                        f"tl_{r*self.width+c}", self, start, cycle
-                    )
-                    self.grid.place_agent(agent, (c, self.height - r - 1))
-                    # self.schedule.add(agent)
-                    traffic_lights.append(agent)
-
-                elif col == "#":
-                    agent = Obstacle(f"ob_{r*self.width+c}", self)
-                    self.grid.place_agent(agent, (c, self.height - r - 1))
-
-                elif col == "D":
-                    agent = Destination(f"d_{r*self.width+c}", self)
-                    self.grid.place_agent(agent, (c, self.height - r - 1))
-                    self.destinations.append((c, self.height - r - 1))
-
+        if prebuilt is not None: # El grafo ya fue calculado para este mapa
+            self.graph = prebuilt["graph"]
+            self.TLDirections = prebuilt["TLDirections"]
+            graphCreated = True
+        if prebuilt is not None and "cells" in prebuilt: # Mapa compilado, el terreno ya viene en arreglos
+            self.occupancy.cells[:] = prebuilt["cells"]
+            self.roadDirections.update(prebuilt["roadDirections"])
+            self.destinations = list(prebuilt["destinations"])
+            traffic_lights = [self.addTrafficLight(pos, symbol) for pos, symbol in prebuilt["lights"]]
+        else:
+            traffic_lights = self.readMap(lines, graphCreated)
 
         for pos, dir in self.TLDirections.items(): 
-            # Creamos los semáforos, son creados aqui porque la direccion que tienen es calculada al crear el grafo
-            # Tambien creamos un Road agent ahi para la visualizacion en webgl
-            TL = self.grid.get_cell_list_contents([pos])[0]
+            # La direccion de los semáforos es calculada al crear el grafo
+            # Debajo de cada semaforo tambien hay calle para la visualizacion en webgl
+            TL = self.occupancy.lights[pos]
             TL.direction = dir
-            agent = Road(self.unique_id, self, (pos[0], pos[1]), dir)
-            self.unique_id += 1
-            self.grid.place_agent(agent, (pos[0], pos[1]))
+            self.roadDirections[pos] = dir
+
+        # Tabla de rutas (siguiente celda por destino), se calcula una sola vez
+        routeTables = {"table": RouteTable, "contracted": ContractedRouteTable}
+        if route_index not in routeTables:
+            raise ValueError(f"Unknown route_index: {route_index}")
+        if prebuilt is not None:
+            self.routes = prebuilt["routes"]
+            if isinstance(self.routes, ContractedRouteTable) != (route_index == "contracted"):
+                raise ValueError(f"prebuilt routes do not match route_index: {route_index}")
+        else:
+            self.routes = routeTables[route_index](self.graph, self.destinations, self.width)
+        self.memo = RouteCache(self.routes, memo_size)
+        self.router = None
+        if routing == "congestion":
+            if batch:
+                raise ValueError("Batch mode only supports static routing")
+            self.router = CongestionRouter(self)
+        elif routing != "static":
+            raise ValueError(f"Unknown routing: {routing}")
 
         # Crear nuestro sheduler
-        self.schedule = CautionScheduler(self)
+        self.schedule = CautionScheduler(self, batch, self.profiler, ordering)
         self.schedule.add_traffic_lights(traffic_lights)
+        if signals == "adaptive":
+            self.schedule.controllers = buildControllers(self)
+        elif signals != "fixed":
+            raise ValueError(f"Unknown signals: {signals}")
+
+        self.gridlock = None
+        if gridlock in ("detect", "recover"):
+            self.gridlock = GridlockDetector(self, recover=gridlock == "recover")
+        elif gridlock != "off":
+            raise ValueError(f"Unknown gridlock: {gridlock}")
 
         self.running = True
         self.url = "http://10.49.12.55:5000/api/"
         self.endpoint = "validate_attempt"
+        self.demand = None
+        if demand is not None: # Los coches llegan con la demanda desde el primer step
+            self.demand = Demand(self, **demand)
+            return
         for pos in self.starting_positions: #Crear coches iniciales
-                car = Car(self.unique_id, self, pos)
-                self.unique_id += 1
+                car = self.newCar(pos)
                 self.schedule.add_car(car)
-                self.grid.place_agent(car, pos)
+                self.placeCar(car, pos)
     
 
     def step(self):
         """Advance the model by one step."""
-        # pprint.pprint(self.memo)
+        # pprint.pprint(self.memo.entries)
 
+        self.tripStats.startStep()
+        start = time.perf_counter()
         self.schedule.step()
-        self.datacollector.collect(self)
+        self.stepTime = time.perf_counter() - start
+        if self.gridlock is not None:
+            self.gridlock.step()
+        if self.metrics is not None:
+            self.metrics.collect(self)
+        else:
+            self.datacollector.collect(self)
         added = True
         
         # Agregamos coches
-        if self.schedule.steps % 1 == 0:
+        if self.demand is not None: # Los que no caben esperan en la fila de su origen
+            self.demand.step(self.schedule.steps)
+        elif self.schedule.steps % 1 == 0:
             added = False
             for pos in self.starting_positions:
                 if self.hasNoCars(pos):
-                    car = Car(self.unique_id, self, pos)
-                    self.unique_id += 1
+                    car = self.newCar(pos)
                     self.schedule.add_car(car)
-                    self.grid.place_agent(car, pos)
+                    self.placeCar(car, pos)
                     added = True
         # if self.schedule.steps % 10 == 0:
             #  self.postStats()
@@ -194,24 +290,244 @@ class CityModel(Model):
             print("stop")
             self.running = False
 
+        if self.router is not None:
+            self.router.endStep(self.schedule.steps)
+        self.changes.endStep(self.schedule.steps)
+
         # with open("data.json", "w") as json_file:
-        #     json.dump(self.memo, json_file, indent=4)
+        #     json.dump(dict(self.memo.entries), json_file, indent=4)
+
+    def snapshotShape(self):
+        # Lo que debe coincidir para restaurar: mismo mapa y misma configuracion
+        return (
+            self.width, self.height, len(self.graph), len(self.schedule.traffic_lights),
+            None if self.schedule.controllers is None else len(self.schedule.controllers),
+            self.schedule.engine is not None, self.schedule.ordering, self.router is not None,
+            self.demand is not None, None if self.gridlock is None else self.gridlock.recover,
+        )
+
+    def snapshot(self):
+        """
+        Estado completo de la simulacion en bytes: coches (con su ruta), semaforos,
+        orden del scheduler, memo, router, estadisticas y generador aleatorio.
+        Se restaura con restore() en un modelo del mismo mapa y configuracion.
+        """
+        schedule = self.schedule
+        if schedule.engine is not None:
+            schedule.engine.sync()
+        state = {
+            "version": SNAPSHOT_VERSION,
+            "shape": self.snapshotShape(),
+            "steps": schedule.steps,
+            "time": schedule.time,
+            "unique_id": self.unique_id,
+            "activeCars": self.activeCars,
+            "arrived": self.arrived,
+            "running": self.running,
+            "random": self.random.getstate(),
+            "cars": [car.getState() for car in schedule.cars],
+            "lights": [(light.go, light.cur) for light in schedule.traffic_lights],
+            "timer": schedule.timer.getState(),
+            "controllers": None if schedule.controllers is None else [c.getState() for c in schedule.controllers],
+            "memo": self.memo.getState(),
+            "router": None if self.router is None else self.router.getState(),
+            "trips": self.tripStats.getState(),
+            "demand": None if self.demand is None else self.demand.getState(),
+            "gridlock": None if self.gridlock is None else self.gridlock.getState(),
+            "collected": self.datacollector.model_vars,
+        }
+        return pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def restore(self, data):
+        """
+        Regresa el modelo al estado de snapshot(). Los clientes de deltas deben pedir todo.
+        data es pickle: solo se deben restaurar estados de una fuente de confianza.
+        """
+        try:
+            state = pickle.loads(data)
+        except (pickle.UnpicklingError, EOFError, TypeError) as e:
+            raise ValueError("Unreadable snapshot") from e
+        if state["version"] != SNAPSHOT_VERSION or state["shape"] != self.snapshotShape():
+            raise ValueError("Snapshot is from a different map or model configuration")
+
+        schedule = self.schedule
+        for car in list(schedule.cars):
+            self.removeCar(car)
+            schedule.remove_car(car)
+            self.releaseCar(car)
+        schedule.cars.compact()
+        schedule.waiting = {}
+        if self.gridlock is not None:
+            self.carPool.extend(car for car, parkedAt in self.gridlock.parked)
+        for carState in state["cars"]:
+            car = self.restoredCar(carState)
+            schedule.add_car(car)
+            self.placeCar(car, car.position)
+            if car.waiting:
+                schedule.waiting[car.position] = car
+
+        for light, (go, cur) in zip(schedule.traffic_lights, state["lights"]):
+            light.go = go
+            light.cur = cur
+        schedule.timer.setState(state["timer"], schedule.traffic_lights)
+        if schedule.controllers is not None:
+            for controller, controllerState in zip(schedule.controllers, state["controllers"]):
+                controller.setState(controllerState)
+        if schedule.engine is not None:
+            schedule.engine.redStale = True
+
+        schedule.steps = state["steps"]
+        schedule.time = state["time"]
+        self.unique_id = state["unique_id"]
+        self.activeCars = state["activeCars"]
+        self.arrived = state["arrived"]
+        self.running = state["running"]
+        self.random.setstate(state["random"])
+        self.memo.setState(state["memo"])
+        if self.router is not None:
+            self.router.setState(state["router"])
+        self.tripStats.setState(state["trips"])
+        if self.demand is not None:
+            self.demand.setState(state["demand"])
+        if self.gridlock is not None:
+            self.gridlock.setState(state["gridlock"], self.restoredCar)
+        self.datacollector.model_vars = state["collected"]
+        self.changes.reset(schedule.steps)
+
+    def restoredCar(self, carState):
+        # Coche (del pool si hay) con el estado de Car.getState
+        car = self.carPool.pop() if self.carPool else Car.__new__(Car)
+        car.setState(self, carState)
+        return car
+
+    def close(self):
+        # Escribe lo que falte de las metricas y cierra los archivos abiertos
+        if self.metrics is not None:
+            self.metrics.close()
+        if self.profiler is not None:
+            self.profiler.close()
+
+    def readMap(self, lines, graphCreated):
+        # Recorre el texto del mapa: terreno, semaforos, destinos y el grafo (si no vino en prebuilt).
+        # Regresa los semaforos en el orden del texto
+        traffic_lights = []
+        for r, row in enumerate(lines):
+            for c, col in enumerate(row):
+                if col in ["v", "^", ">", "<"]:
+                    # El terreno solo se guarda en occupancy y roadDirections (ver staticAgents)
+                    self.occupancy.setCell((c, self.height - r - 1), ROAD)
+                    self.roadDirections[(c, self.height - r - 1)] = CityModel.mapData[col]
+
+                    if not graphCreated: #Creamos el grafo al encontrar el primer Road en el mapa
+                        p = (c, self.height - r - 1)
+                        self.createGraph(lines, (c, self.height - r - 1))
+                        graphCreated = True
+
+
+                elif col in ["S", "s"]: # Semáforos
+                    traffic_lights.append(self.addTrafficLight((c, self.height - r - 1), col))
+
+                elif col == "#":
+                    self.occupancy.setCell((c, self.height - r - 1), OBSTACLE)
+
+                elif col == "D":
+                    self.occupancy.setCell((c, self.height - r - 1), DESTINATION)
+                    self.destinations.append((c, self.height - r - 1))
+        return traffic_lights
+
+    def addTrafficLight(self, pos, symbol):
+        # symbol es "S" (empieza en verde) o "s"
+        cycle = 7
+        start = True if symbol == "S" else False
+        r = self.height - pos[1] - 1
+        agent = Traffic_Light(
+            f"tl_{r*self.width+pos[0]}", self, start, cycle, CityModel.mapData[symbol]
+        )
+        self.grid.place_agent(agent, pos)
+        self.occupancy.addLight(pos, agent)
+        return agent
+
+    def getPrebuilt(self):
+        """Regresa lo que no cambia entre modelos del mismo mapa, para compartirlo."""
+        return {
+            "graph": self.graph,
+            "TLDirections": self.TLDirections,
+            "routes": self.routes,
+        }
+
+    def staticAgents(self):
+        """
+        Agentes de terreno (Road, Obstacle, Destination) para la visualizacion.
+        No estan en el grid ni en el scheduler; se crean la primera vez que se piden.
+        """
+        if self.staticCells is None:
+            cells = self.occupancy.cells
+            self.staticCells = []
+            for x in range(self.width):
+                for y in range(self.height):
+                    index = (self.height - y - 1) * self.width + x
+                    if (x, y) in self.roadDirections:
+                        agent = Road(f"r_{index}", self, (x, y), self.roadDirections[(x, y)])
+                    elif cells[x, y] == OBSTACLE:
+                        agent = Obstacle(f"ob_{index}", self)
+                    elif cells[x, y] == DESTINATION:
+                        agent = Destination(f"d_{index}", self)
+                    else:
+                        continue
+                    agent.pos = (x, y)
+                    self.staticCells.append(agent)
+        return self.staticCells
 
     def getRandomDest(self):
         return self.random.choice(self.destinations)
 
     def hasNoCars(self, pos):
-        agents = self.grid.get_cell_list_contents(pos)
-
-        for a in agents:
-            if isinstance(a, Car):
-                return False
-        return True
+        return not self.occupancy.hasCar(pos)
+
+    def newCar(self, pos, destination=None):
+        # Reusa un coche que ya llego (carPool) antes de crear uno nuevo
+        if self.carPool:
+            car = self.carPool.pop()
+            car.reset(self.unique_id, pos, destination)
+        else:
+            car = Car(self.unique_id, self, pos, destination)
+        self.unique_id += 1
+        return car
+
+    def releaseCar(self, car):
+        # El coche ya se quito del grid y del scheduler
+        car.plan = None
+        self.carPool.append(car)
+
+    # Los coches siempre se colocan, mueven y quitan con estos metodos
+    # para que el MultiGrid y la capa de ocupacion no se desincronicen
+    def placeCar(self, car, pos):
+        self.grid.place_agent(car, pos)
+        self.occupancy.placeCar(car, pos)
+        self.changes.carChanged(car)
+
+    def moveCar(self, car, pos):
+        self.occupancy.moveCar(car, car.pos, pos)
+        self.grid.move_agent(car, pos)
+        self.changes.carChanged(car)
+
+    def removeCar(self, car):
+        self.occupancy.removeCar(car, car.pos)
+        self.grid.remove_agent(car)
+        self.changes.carArrived(car)
+
+    def shiftCars(self, cars):
+        # Mueve a la vez coches en ciclo: cada uno entra a la celda que deja otro
+        for car in cars:
+            self.occupancy.removeCar(car, car.pos)
+            self.grid.remove_agent(car)
+        for car in cars:
+            self.grid.place_agent(car, car.nextMove)
+            self.occupancy.placeCar(car, car.nextMove)
+            self.changes.carChanged(car)
 
     def addStepCount(self, steps):
-
-        if steps in self.steps_distribution:
-            self.steps_distribution[steps] += 1
+        self.tripStats.add(steps)
 
     def directionsDecode(self, cur, lines):
 
@@ -0,0 +1,87 @@
+import numpy as np
+
+# Codigos del tipo de celda
+EMPTY = 0
+ROAD = 1
+DESTINATION = 2
+OBSTACLE = 3
+TRAFFIC_LIGHT = 4
+
+
+class OccupancyGrid:
+    """
+    Capa de ocupacion en arreglos de NumPy, paralela al MultiGrid del modelo.
+        cells[x, y] -> codigo del tipo de celda (estatico)
+        carIds[x, y] -> unique_id del coche en la celda, -1 si no hay
+    Asi revisar si hay coche, semaforo u obstaculo es una sola consulta.
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.cells = np.zeros((width, height), dtype=np.uint8)
+        self.carIds = np.full((width, height), -1, dtype=np.int32)
+        self.cars = {}  # unique_id -> Car
+        self.lights = {}  # pos -> Traffic_Light
+        self.watched = {}  # pos -> Car o None, solo en las celdas de watch()
+
+    def setCell(self, pos, code):
+        self.cells[pos] = code
+
+    def addLight(self, pos, light):
+        self.cells[pos] = TRAFFIC_LIGHT
+        self.lights[pos] = light
+
+    def watch(self, cells):
+        """
+        Indice por posicion de algunas celdas (danger y pre danger squares) que se
+        mantiene al dia con cada movimiento, para no consultar carIds cada step.
+        """
+        for pos in cells:
+            self.watched[pos] = self.carAt(pos)
+
+    def refreshWatched(self):
+        # Para quien escribe carIds directo (BatchEngine.commit)
+        for pos in self.watched:
+            self.watched[pos] = self.carAt(pos)
+
+    def placeCar(self, car, pos):
+        self.carIds[pos] = car.unique_id
+        self.cars[car.unique_id] = car
+        if pos in self.watched:
+            self.watched[pos] = car
+
+    def moveCar(self, car, old, new):
+        self.carIds[old] = -1
+        self.carIds[new] = car.unique_id
+        if old in self.watched:
+            self.watched[old] = None
+        if new in self.watched:
+            self.watched[new] = car
+
+    def removeCar(self, car, pos):
+        self.carIds[pos] = -1
+        del self.cars[car.unique_id]
+        if pos in self.watched:
+            self.watched[pos] = None
+
+    def hasCar(self, pos):
+        return self.carIds[pos] >= 0
+
+    def carAt(self, pos):
+        """Regresa el coche en pos, o None si no hay."""
+        carId = self.carIds[pos]
+        if carId < 0:
+            return None
+        return self.cars[int(carId)]
+
+    def isFree(self, pos):
+        # Libre si es calle (o vacio) y no hay coche
+        return self.cells[pos] <= ROAD and self.carIds[pos] < 0
+
+    def isRed(self, pos):
+        light = self.lights.get(pos)
+        return light is not None and not light.go
+
+    def inBounds(self, pos):
+        return 0 <= pos[0] < self.width and 0 <= pos[1] < self.height
@@ -0,0 +1,74 @@
+import json
+import time
+
+# Fases de CautionScheduler.step en cada modo
+SCHEDULER_PHASES = ["lights", "danger", "normal", "pre_danger"]
+BATCH_PHASES = ["lights", "danger", "rest", "commit"]
+DEPENDENCY_PHASES = ["lights", "graph", "activate"]
+
+
+class PhaseProfiler:
+    """
+    Mide el tiempo y los agentes activados en cada fase de CautionScheduler.step.
+    Tambien cuenta los coches que se activaron mas de una vez en el step o que se
+    saltaron. Solo existe si el modelo se crea con profile=True; si no, el
+    scheduler no hace ninguna medicion.
+    Si se da tracePath se escribe una linea JSON por step.
+    """
+
+    def __init__(self, phases, tracePath=None):
+        self.phases = phases
+        self.traceFile = open(tracePath, "a", buffering=1) if tracePath else None
+        self.times = {}
+        self.counts = {}
+        self.multiStepped = 0
+        self.skipped = 0
+        self.mark = 0
+
+    def startStep(self):
+        self.times = {}
+        self.counts = {}
+        self.mark = time.perf_counter()
+
+    def phase(self, name, count=None):
+        # Cierra la fase `name` con el tiempo desde la fase anterior
+        now = time.perf_counter()
+        self.times[name] = self.times.get(name, 0) + now - self.mark
+        if count is not None:
+            self.counts[name] = count
+        self.mark = now
+
+    def endStep(self, step, counts, multiStepped, skipped):
+        self.counts.update(counts)
+        self.multiStepped = multiStepped
+        self.skipped = skipped
+
+        if self.traceFile is not None:
+            record = {
+                "step": step,
+                "phases": {
+                    name: {
+                        "ms": self.times.get(name, 0) * 1000,
+                        "agents": self.counts.get(name, 0),
+                    }
+                    for name in self.phases
+                },
+                "multiStepped": multiStepped,
+                "skipped": skipped,
+            }
+            self.traceFile.write(json.dumps(record) + "\n")
+
+    def reporters(self):
+        """Reporters para el DataCollector del modelo."""
+        reporters = {}
+        for name in self.phases:
+            reporters[f"Phase {name} ms"] = lambda m, name=name: self.times.get(name, 0) * 1000
+            reporters[f"Phase {name} agents"] = lambda m, name=name: self.counts.get(name, 0)
+        reporters["Multi Stepped"] = lambda m: self.multiStepped
+        reporters["Skipped"] = lambda m: self.skipped
+        return reporters
+
+    def close(self):
+        if self.traceFile is not None:
+            self.traceFile.close()
+            self.traceFile = None
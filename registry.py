@@ -0,0 +1,40 @@
+class CarRegistry:
+    """
+    Coches del scheduler en orden de llegada, con agregar y quitar en O(1).
+    Al quitar un coche queda un hueco (None) en su lugar, asi que se puede quitar
+    coches mientras se recorre la lista sin saltarse al siguiente. Los huecos se
+    quitan con compact(), que el scheduler llama al empezar cada step.
+    """
+
+    def __init__(self):
+        self.slots = []
+        self.index = {}  # unique_id -> posicion en slots
+
+    def add(self, car):
+        self.index[car.unique_id] = len(self.slots)
+        self.slots.append(car)
+
+    def remove(self, car):
+        self.slots[self.index.pop(car.unique_id)] = None
+
+    def order(self, car):
+        # Posicion del coche en el orden de llegada
+        return self.index[car.unique_id]
+
+    def compact(self):
+        # Solo si al menos la mitad son huecos; no se debe llamar mientras se recorre
+        if len(self.slots) < 2 * len(self.index) or not self.slots:
+            return
+        self.slots = [car for car in self.slots if car is not None]
+        self.index = {car.unique_id: i for i, car in enumerate(self.slots)}
+
+    def __contains__(self, car):
+        return car.unique_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for car in self.slots:
+            if car is not None:
+                yield car
@@ -0,0 +1,553 @@
+import heapq
+from collections import deque, OrderedDict
+import numpy as np
+
+
+class RouteTable:
+    """
+    Tabla de rutas precalculada (next-hop) sobre el grafo del modelo.
+    Se construye una sola vez con un BFS inverso desde cada destino:
+        table[cell][destination] -> siguiente celda de la ruta
+        distances[destination][cell] -> numero de pasos para llegar
+    """
+
+    def __init__(self, graph, destinations, width):
+        self.graph = graph
+        self.width = width
+        self.destinations = list(destinations)
+        self.destinationIds = {dest: i for i, dest in enumerate(self.destinations)}
+        self.table = {}
+        self.distances = {}
+        self.nextCellCache = None
+
+        # Grafo inverso: quien puede llegar a cada celda
+        self.reverse = {}
+        for cell, moves in graph.items():
+            for move in moves:
+                self.reverse.setdefault(move, []).append(cell)
+
+        for dest in self.destinations:
+            self.addDestination(dest)
+
+    def addDestination(self, dest):
+        # BFS inverso desde el destino para conocer la distancia de cada celda
+        dist = {dest: 0}
+        queue = deque([dest])
+
+        while queue:
+            cur = queue.popleft()
+            for prev in self.reverse.get(cur, []):
+                if prev not in dist:
+                    dist[prev] = dist[cur] + 1
+                    queue.append(prev)
+
+        self.distances[dest] = dist
+
+        # El siguiente paso es el primer vecino (en el orden del grafo) que esta
+        # un paso mas cerca, asi las rutas son las mismas que daba el BFS por coche
+        for cell, d in dist.items():
+            if d == 0:
+                continue
+            for move in self.graph[cell]:
+                if dist.get(move) == d - 1:
+                    self.table.setdefault(cell, {})[dest] = move
+                    break
+
+    def nextCellArray(self, height):
+        """
+        La tabla en arreglos de NumPy (para BatchEngine), con una columna por celda del grafo:
+            roadIndex[x, y] -> columna de la celda (len(graph) si no esta en el grafo)
+            moveCells[moveStart[columna] + k] -> x * height + y del k-esimo movimiento
+            nextMove[destId, columna] -> k de la siguiente celda hacia destId (-1 si no hay)
+        nextMove es int8: un byte por destino y celda de calle, no por celda del mapa.
+        Se calcula una vez y se comparte entre modelos del mismo mapa.
+        """
+        if self.nextCellCache is None:
+            cells = list(self.graph)
+            roadIndex = np.full((self.width, height), len(cells), dtype=np.int32)
+            moveStart = np.zeros(len(cells) + 1, dtype=np.int32)
+            moveCells = []
+            for column, cell in enumerate(cells):
+                roadIndex[cell] = column
+                moveStart[column] = len(moveCells)
+                moveCells += [m[0] * height + m[1] for m in self.graph[cell]]
+            moveStart[len(cells)] = len(moveCells)
+            moveCells.append(-1)  # La columna de las celdas fuera del grafo no tiene movimientos
+
+            # Igual que nextHop: el primer movimiento (en el orden del grafo) un paso mas cerca
+            reachable = set(cells).union(*self.graph.values())
+            nextMove = np.full((len(self.destinations), len(cells) + 1), -1, dtype=np.int8)
+            for dest, destId in self.destinationIds.items():
+                dist = {cell: self.distance(cell, dest) for cell in reachable}
+                row = [-1] * (len(cells) + 1)
+                for column, cell in enumerate(cells):
+                    d = dist[cell]
+                    if not d:
+                        continue
+                    for k, move in enumerate(self.graph[cell]):
+                        if dist[move] == d - 1:
+                            row[column] = k
+                            break
+                nextMove[destId] = row
+            self.nextCellCache = (roadIndex, moveStart, np.array(moveCells, dtype=np.int32), nextMove)
+        return self.nextCellCache
+
+    def toArrays(self, height):
+        """
+        La tabla en arreglos para guardarla en el artefacto del mapa (ver mapcompiler):
+        las distancias de cada celda alcanzable (-1 si no hay ruta) y los arreglos de
+        nextCellArray, de donde sale la siguiente celda.
+        """
+        cells = sorted(set(self.graph).union(*self.graph.values()))
+        distances = np.full((len(self.destinations), len(cells)), -1, dtype=np.int32)
+        for dest, destId in self.destinationIds.items():
+            dist = self.distances[dest]
+            distances[destId] = [dist.get(cell, -1) for cell in cells]
+        roadIndex, moveStart, moveCells, nextMove = self.nextCellArray(height)
+        return {
+            "route_cells": np.array(cells, dtype=np.int32).reshape(-1, 2),
+            "route_distances": distances,
+            "route_road_index": roadIndex,
+            "route_move_start": moveStart,
+            "route_move_cells": moveCells,
+            "route_next_move": nextMove,
+        }
+
+    def cellId(self, cell):
+        return cell[1] * self.width + cell[0]
+
+    def cellFromId(self, cellId):
+        return (cellId % self.width, cellId // self.width)
+
+    def nextHop(self, cell, dest):
+        """Regresa la siguiente celda hacia dest, o None si ya llego o no hay ruta."""
+        hops = self.table.get(cell)
+        if hops is None:
+            return None
+        return hops.get(dest)
+
+    def distance(self, cell, dest):
+        """Regresa cuantos pasos faltan para llegar, o None si no hay ruta."""
+        return self.distances[dest].get(cell)
+
+    def route(self, cell, dest):
+        """Reconstruye la ruta completa (sin incluir cell) siguiendo la tabla."""
+        path = []
+        while cell != dest:
+            cell = self.nextHop(cell, dest)
+            if cell is None:
+                return None
+            path.append(cell)
+        return path
+
+
+class SegmentIndex:
+    """
+    Grafo de rutas comprimido: las calles rectas (con sus cambios de carril) se
+    juntan en aristas con peso entre cruces.
+    Una celda es interior si solo sigue derecho o cambia a un carril paralelo, y solo
+    le llegan coches de atras o del carril paralelo; todas las demas (vueltas,
+    incorporaciones, entradas a destinos) son nodos del grafo comprimido.
+        exits[celda interior] -> [(nodo, pasos)] primeros nodos a los que llega sin
+            pasar por otro nodo
+        edges[nodo] -> {nodo: pasos}
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+
+        direction = {
+            cell: (moves[0][0] - cell[0], moves[0][1] - cell[1]) for cell, moves in graph.items()
+        }
+        reverse = {}
+        for cell, moves in graph.items():
+            for move in moves:
+                reverse.setdefault(move, []).append(cell)
+
+        def parallel(a, b):
+            # b es el carril de al lado de a, en la misma direccion
+            d = direction.get(a)
+            return d is not None and direction.get(b) == d and (b[0] - a[0]) * d[0] + (b[1] - a[1]) * d[1] == 0
+
+        self.interior = set()
+        for cell, moves in graph.items():
+            d = direction[cell]
+            behind = (cell[0] - d[0], cell[1] - d[1])
+            if all(parallel(cell, m) for m in moves[1:]) and all(
+                (p == behind and direction.get(p) == d) or parallel(cell, p)
+                for p in reverse.get(cell, [])
+            ):
+                self.interior.add(cell)
+
+        # Hacia atras desde cada nodo, solo por celdas interiores
+        nodes = [c for c in list(graph) + [c for c in reverse if c not in graph] if c not in self.interior]
+        self.exits = {}
+        for node in nodes:
+            queue = deque([node])
+            dist = {node: 0}
+            while queue:
+                cur = queue.popleft()
+                for prev in reverse.get(cur, []):
+                    if prev in self.interior and prev not in dist:
+                        dist[prev] = dist[cur] + 1
+                        self.exits.setdefault(prev, []).append((node, dist[prev]))
+                        queue.append(prev)
+
+        self.edges = {}
+        for node in nodes:
+            if node not in graph:  # Destinos
+                continue
+            edges = self.edges.setdefault(node, {})
+            for move in graph[node]:
+                hops = self.exits.get(move, []) if move in self.interior else [(move, 0)]
+                for target, steps in hops:
+                    if steps + 1 < edges.get(target, float("inf")):
+                        edges[target] = steps + 1
+
+        self.reverseEdges = {}
+        for node, edges in self.edges.items():
+            for target, steps in edges.items():
+                self.reverseEdges.setdefault(target, []).append((node, steps))
+
+    def __len__(self):
+        return len(self.edges)
+
+    def distancesTo(self, dest):
+        """Dijkstra inverso sobre el grafo comprimido: pasos de cada nodo a dest."""
+        dist = {dest: 0}
+        heap = [(0, dest)]
+        while heap:
+            d, node = heapq.heappop(heap)
+            if d > dist[node]:
+                continue
+            for prev, steps in self.reverseEdges.get(node, []):
+                if d + steps < dist.get(prev, float("inf")):
+                    dist[prev] = d + steps
+                    heapq.heappush(heap, (d + steps, prev))
+        return dist
+
+
+class ContractedRouteTable(RouteTable):
+    """
+    Misma interfaz y mismas rutas que RouteTable, pero solo guarda distancias de los
+    nodos del SegmentIndex, calculadas la primera vez que se pide cada destino; las de
+    las celdas interiores y la siguiente celda se calculan al pedirlas (y la
+    siguiente celda se guarda).
+    Construirla depende del numero de cruces y no del area del mapa.
+    """
+
+    def __init__(self, graph, destinations, width):
+        self.graph = graph
+        self.width = width
+        self.destinations = list(destinations)
+        self.destinationIds = {dest: i for i, dest in enumerate(self.destinations)}
+        self.index = SegmentIndex(graph)
+        self.hops = {}  # (celda, destino) -> siguiente celda ya calculada
+        self.nodeDistances = {}  # destino -> distancias de los nodos, al primer uso
+        self.nextCellCache = None
+
+    def distance(self, cell, dest):
+        dist = self.nodeDistances.get(dest)
+        if dist is None:
+            dist = self.nodeDistances[dest] = self.index.distancesTo(dest)
+        exits = self.index.exits.get(cell)
+        if exits is None:
+            return dist.get(cell)
+        best = None
+        for node, steps in exits:
+            if node in dist and (best is None or steps + dist[node] < best):
+                best = steps + dist[node]
+        return best
+
+    def nextHop(self, cell, dest):
+        key = (cell, dest)
+        if key in self.hops:
+            return self.hops[key]
+
+        # Igual que RouteTable: el primer vecino (en el orden del grafo) un paso mas cerca
+        nextCell = None
+        d = self.distance(cell, dest)
+        if d and cell in self.graph:
+            for move in self.graph[cell]:
+                if self.distance(move, dest) == d - 1:
+                    nextCell = move
+                    break
+        self.hops[key] = nextCell
+        return nextCell
+
+
+class StoredRouteTable(RouteTable):
+    """
+    Misma interfaz y mismas rutas que RouteTable, leida de los arreglos de toArrays
+    (el artefacto del mapa) en lugar de repetir un BFS por destino. nextHop y
+    distance consultan los arreglos directo, sin armar los diccionarios.
+    """
+
+    def __init__(self, graph, destinations, width, arrays):
+        self.graph = graph
+        self.width = width
+        self.destinations = list(destinations)
+        self.destinationIds = {dest: i for i, dest in enumerate(self.destinations)}
+        self.columns = {tuple(cell): i for i, cell in enumerate(arrays["route_cells"].tolist())}
+        self.distanceArray = arrays["route_distances"]
+        self.nextCellCache = (
+            arrays["route_road_index"], arrays["route_move_start"],
+            arrays["route_move_cells"], arrays["route_next_move"],
+        )
+        self.roadIndex = arrays["route_road_index"]
+        self.nextMove = arrays["route_next_move"]
+
+    def distance(self, cell, dest):
+        column = self.columns.get(cell)
+        if column is None:
+            return None
+        d = self.distanceArray.item(self.destinationIds[dest], column)
+        return None if d < 0 else d
+
+    def nextHop(self, cell, dest):
+        moves = self.graph.get(cell)
+        if moves is None:
+            return None
+        k = self.nextMove.item(self.destinationIds[dest], self.roadIndex.item(cell))
+        return None if k < 0 else moves[k]
+
+
+class RouteCache:
+    """
+    Memo de rutas con llaves enteras (celda, destino) y tamaño maximo (LRU).
+    Cada entrada solo guarda la llave de la siguiente celda de la ruta, asi
+    una ruta es un apuntador al sufijo de otra en lugar de una lista copiada.
+    get() responde desde las entradas; la tabla solo se recorre en un miss.
+    """
+
+    def __init__(self, table, maxSize=4096, insertLimit=32):
+        self.table = table
+        self.maxSize = maxSize
+        self.insertLimit = insertLimit  # Maximo de celdas que se guardan por miss
+        self.entries = OrderedDict()
+        self.numDestinations = len(table.destinations)
+
+        # Estadisticas
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, cell, dest):
+        return self.table.cellId(cell) * self.numDestinations + self.table.destinationIds[dest]
+
+    def get(self, cell, dest):
+        """Regresa la siguiente celda de cell hacia dest, registrando hit o miss."""
+        key = self.key(cell, dest)
+
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        else:
+            self.misses += 1
+            self.insert(cell, dest)
+            if key not in self.entries:  # cell ya es el destino, o un memo sin espacio
+                return self.table.nextHop(cell, dest)
+
+        nextKey = self.entries[key]
+        if nextKey is None:  # No hay ruta
+            return None
+        return self.table.cellFromId(nextKey // self.numDestinations)
+
+    def insert(self, cell, dest):
+        # Guardamos la ruta hasta encontrar un sufijo que ya este en el memo, a lo mas
+        # insertLimit celdas: en mapas grandes la ruta completa desalojaria todo el memo
+        path = []
+        while cell is not None and cell != dest and len(path) < self.insertLimit:
+            key = self.key(cell, dest)
+            if key in self.entries:
+                break
+            nextCell = self.table.nextHop(cell, dest)
+            path.append((key, None if nextCell is None else self.key(nextCell, dest)))
+            cell = nextCell
+
+        # Se insertan del final al inicio para que la celda pedida sea la mas reciente
+        for key, nextKey in reversed(path):
+            self.entries[key] = nextKey
+        self.evict()
+
+    def evict(self):
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def getState(self):
+        return (OrderedDict(self.entries), self.hits, self.misses, self.evictions)
+
+    def setState(self, state):
+        entries, self.hits, self.misses, self.evictions = state
+        self.entries = OrderedDict(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class CongestionRouter:
+    """
+    Rutas con pesos de congestion (A*) cuando la ruta de la tabla se congestiona.
+    El costo de entrar a una celda es su tiempo promedio de paso (EWMA de cuantos
+    steps se quedan los coches ahi) mas una penalizacion si tiene coche. Los costos
+    se congelan por epoca (epochLength steps); las rutas se guardan por
+    (celda, destino) dentro de la epoca y se tiran al cambiar de epoca.
+    Un coche sigue la tabla (car.plan = None) mientras lo que le falta cueste menos
+    de (1 + threshold) veces su costo sin trafico; si no, planea con A*. Solo se
+    revisa una vez por epoca.
+    La heuristica de A* es la distancia en pasos de la tabla, que nunca sobreestima
+    porque cada celda cuesta al menos 1.
+    """
+
+    def __init__(self, model, epochLength=10, threshold=0.7, occupiedCost=1.0, alpha=0.1, maxSize=50000):
+        self.model = model
+        self.routes = model.routes
+        self.graph = model.graph
+        self.epochLength = epochLength
+        self.threshold = threshold
+        self.occupiedCost = occupiedCost
+        self.alpha = alpha
+        self.maxSize = maxSize
+        self.laneChangeCost = 0.01  # Desempate: con el mismo costo se prefiere seguir derecho
+
+        self.dwell = np.ones((model.width, model.height))  # EWMA del tiempo de paso por celda
+        self.costs = self.dwell.tolist()
+        self.epoch = 0
+        self.plans = {}  # (celda, destino) -> siguiente celda, solo de la epoca actual
+
+        # Estadisticas
+        self.hits = 0
+        self.misses = 0
+        self.replans = 0
+
+    def endStep(self, step):
+        # Nueva epoca: congelamos los costos actuales y tiramos las rutas viejas
+        if step % self.epochLength:
+            return
+        costs = self.dwell + self.occupiedCost * (self.model.occupancy.carIds >= 0)
+        self.costs = costs.tolist()
+        self.epoch += 1
+        self.plans = {}
+
+    def getState(self):
+        return (
+            self.dwell.copy(), self.costs, self.epoch, dict(self.plans),
+            self.hits, self.misses, self.replans,
+        )
+
+    def setState(self, state):
+        dwell, costs, self.epoch, plans, self.hits, self.misses, self.replans = state
+        self.dwell = dwell.copy()
+        self.costs = [list(column) for column in costs]
+        self.plans = dict(plans)
+
+    def observe(self, cell, dwell):
+        # Un coche salio de cell despues de `dwell` steps
+        self.dwell[cell] += self.alpha * (dwell - self.dwell[cell])
+
+    def search(self, start, dest):
+        """A* de start a dest con los costos de la epoca. Regresa el camino sin start, o None."""
+        routes = self.routes
+        h = {}  # Heuristica ya calculada por celda
+        hStart = routes.distance(start, dest)
+        if hStart is None:
+            return None
+        h[start] = hStart
+        costs = self.costs
+        g = {start: 0}
+        parent = {}
+        counter = 0
+        heap = [(h[start], counter, start)]
+        closed = set()
+
+        while heap:
+            _, _, cell = heapq.heappop(heap)
+            if cell == dest:
+                break
+            if cell in closed:
+                continue
+            closed.add(cell)
+            for i, move in enumerate(self.graph.get(cell, ())):
+                if move not in h:
+                    h[move] = routes.distance(move, dest)
+                if h[move] is None:
+                    continue
+                cost = g[cell] + costs[move[0]][move[1]] + (self.laneChangeCost if i else 0)
+                if cost < g.get(move, float("inf")):
+                    g[move] = cost
+                    parent[move] = cell
+                    counter += 1
+                    heapq.heappush(heap, (cost + h[move], counter, move))
+        else:
+            return None
+
+        path = [dest]
+        while path[-1] != start:
+            path.append(parent[path[-1]])
+        path.reverse()
+        return path[1:]
+
+    def path(self, start, dest):
+        # Cada sufijo de una ruta optima tambien es optimo: se guarda la siguiente celda de todas
+        if (start, dest) in self.plans:
+            self.hits += 1
+            path = []
+            cell = start
+            while cell != dest:
+                cell = self.plans[(cell, dest)]
+                path.append(cell)
+            return path
+
+        self.misses += 1
+        path = self.search(start, dest)
+        if path is not None and len(self.plans) < self.maxSize:
+            cell = start
+            for move in path:
+                self.plans[(cell, dest)] = move
+                cell = move
+        return path
+
+    def congested(self, path):
+        costs = self.costs
+        cost = sum(costs[c[0]][c[1]] for c in path)
+        return cost > (1 + self.threshold) * len(path)
+
+    def route(self, car, start):
+        """Elige la ruta del coche desde start (tabla o A*). Regresa la siguiente celda (o None)."""
+        car.planEpoch = self.epoch
+        static = self.routes.route(start, car.destination)
+        if not static or not self.congested(static):
+            car.plan = None
+            return static[0] if static else None
+
+        path = self.path(start, car.destination)
+        car.plan = deque(path) if path else deque()
+        return car.plan[0] if car.plan else None
+
+    def advance(self, car, old, new):
+        """El coche paso de old a new. Regresa su siguiente celda."""
+        steps = self.model.schedule.steps
+        self.observe(old, steps - car.enteredAt)
+        car.enteredAt = steps
+
+        if car.plan is None:
+            if car.planEpoch == self.epoch:
+                return self.routes.nextHop(new, car.destination)
+        elif car.plan and car.plan[0] == new:
+            car.plan.popleft()
+            if car.planEpoch == self.epoch or not car.plan:
+                return car.plan[0] if car.plan else None
+        else:
+            # Se salio de su ruta (cambio de carril)
+            return self.route(car, new)
+
+        # Nueva epoca: se vuelve a elegir solo si lo que falta ya esta congestionado
+        car.planEpoch = self.epoch
+        remaining = car.plan if car.plan is not None else self.routes.route(new, car.destination) or []
+        if remaining and self.congested(remaining):
+            self.replans += 1
+            return self.route(car, new)
+        if car.plan is not None:
+            return car.plan[0]
+        return remaining[0] if remaining else None
@@ -0,0 +1,126 @@
+# Corridas sin interfaz de CityModel: N seeds x mapas x conjuntos de parametros,
+# repartidas en un pool de procesos.
+#
+#   python runner.py --maps 2022_base.txt 2024_base.txt --seeds 0 1 2 --steps 500 \
+#       --params '{"batch": true}' --out results.json
+#
+# Con --metrics-dir cada corrida escribe sus metricas por step a disco (ver metrics.py)
+# y las series del resultado se leen de ahi.
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+from model import CityModel
+from mapcompiler import loadMap
+from metrics import loadMetrics
+
+# Mapas ya procesados (lineas, grafo y tabla de rutas), compartidos por los procesos
+_maps = {}
+
+
+def prepareMaps(paths, routeIndexes=("table",)):
+    """
+    Carga cada mapa compilado (ver mapcompiler) para calcular el grafo y las rutas una sola vez,
+    con una tabla de rutas por cada route_index que pidan las corridas.
+    """
+    maps = {}
+    for path in paths:
+        compiled = loadMap(path)
+        prebuilts = {index: compiled.prebuilt(index) for index in routeIndexes}
+        maps[path] = (compiled.lines, compiled.width, compiled.height, prebuilts)
+    return maps
+
+
+def _initWorker(maps):
+    # Con fork los mapas se comparten sin copiarse; con spawn se copian una vez por proceso
+    global _maps
+    _maps = maps
+
+
+def runOne(job):
+    """Corre un modelo por `steps` pasos y regresa sus series (del datacollector o de disco)."""
+    path, seed, params, steps, metricsPath = job
+    lines, width, height, prebuilts = _maps[path]
+    params = dict(params)
+    steps_dist_max = params.pop("steps_dist_max", 100)
+    prebuilt = prebuilts[params.get("route_index", "table")]
+
+    model = CityModel(
+        width, height, lines, steps_dist_max, prebuilt=prebuilt, seed=seed,
+        metrics_path=metricsPath, **params,
+    )
+    for _ in range(steps):
+        if not model.running:
+            break
+        model.step()
+    model.close()
+
+    if metricsPath is not None:
+        series = loadMetrics(metricsPath)
+    else:
+        series = model.datacollector.get_model_vars_dataframe()
+    return {
+        "map": path,
+        "seed": seed,
+        "params": dict(job[2]),
+        "steps": model.schedule.steps,
+        "ActiveCars": series["ActiveCars"].tolist(),
+        "Arrived": series["Arrived"].tolist(),
+        "Memoization": series["Memoization"].tolist(),
+        "No Memoization": series["No Memoization"].tolist(),
+        "steps_distribution": model.tripStats.hist.tolist(),
+        "trip_stats": model.tripStats.summary(),
+    }
+
+
+def runBatch(maps, seeds, paramSets=({},), steps=500, processes=None, metricsDir=None):
+    """
+    Corre todas las combinaciones de mapas x seeds x parametros.
+    Regresa una lista de resultados (ver runOne) en el mismo orden que las combinaciones.
+    Con metricsDir, la corrida k escribe sus metricas en metricsDir/<mapa>_seed<seed>_<k>.
+    """
+    prepared = prepareMaps(maps, sorted({p.get("route_index", "table") for p in paramSets}))
+    jobs = []
+    for k, (path, seed, params) in enumerate(itertools.product(maps, seeds, paramSets)):
+        metricsPath = None
+        if metricsDir is not None:
+            name = os.path.splitext(os.path.basename(path))[0]
+            metricsPath = os.path.join(metricsDir, f"{name}_seed{seed}_{k}")
+        jobs.append((path, seed, params, steps, metricsPath))
+
+    if processes == 1:
+        _initWorker(prepared)
+        return [runOne(job) for job in jobs]
+
+    with multiprocessing.Pool(processes, initializer=_initWorker, initargs=(prepared,)) as pool:
+        return pool.map(runOne, jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Corre CityModel sin interfaz en paralelo.")
+    parser.add_argument("--maps", nargs="+", default=["2022_base.txt", "2023_base.txt", "2024_base.txt"])
+    parser.add_argument("--seeds", nargs="+", type=int, default=[0])
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument(
+        "--params", nargs="+", default=["{}"],
+        help="Uno o mas diccionarios JSON con parametros extra de CityModel",
+    )
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--out", default="results.json")
+    parser.add_argument("--metrics-dir", default=None, help="Escribir las metricas por step a disco")
+    args = parser.parse_args()
+
+    paramSets = [json.loads(p) for p in args.params]
+    results = runBatch(args.maps, args.seeds, paramSets, args.steps, args.processes, args.metrics_dir)
+
+    with open(args.out, "w") as json_file:
+        json.dump(results, json_file)
+
+    for r in results:
+        print(r["map"], r["seed"], r["params"], "steps:", r["steps"], "arrived:", r["Arrived"][-1])
+
+
+if __name__ == "__main__":
+    main()
@@ -74,6 +74,25 @@ def agent_portrayal(agent):
         
     return portrayal
 
+class CityCanvasGrid(CanvasGrid):
+    """CanvasGrid que tambien dibuja el terreno, que no esta en el grid del modelo."""
+
+    def render(self, model):
+        grid_state = super().render(model)
+        for agent in model.staticAgents():
+            portrayal = self.portrayal_method(agent)
+            if portrayal:
+                portrayal["x"], portrayal["y"] = agent.pos
+                grid_state[portrayal["Layer"]].append(portrayal)
+        return grid_state
+
+class TripHistogramChart(BarChartModule):
+    """Grafica de barras leida directo de model.tripStats.hist (el ultimo bucket es el de N o mas)."""
+
+    def render(self, model):
+        hist = model.tripStats.hist
+        return [{f["Label"]: int(hist[i + 1]) for i, f in enumerate(self.fields)}]
+
 width = 0
 height = 0
 
@@ -106,8 +125,9 @@ arrived_chart_element = mesa.visualization.ChartModule(
 )
 
 
-steps_bar_chart = BarChartModule(
-    [{"Label": str(i), "Color": random_color()} for i in range(1, steps_dist_max + 1)], 
+steps_bar_chart = TripHistogramChart(
+    [{"Label": str(i), "Color": random_color()} for i in range(1, steps_dist_max)]
+    + [{"Label": f"{steps_dist_max}+", "Color": random_color()}],
     data_collector_name="datacollector"
 )
 
@@ -119,7 +139,7 @@ memo_pie_chart = PieChartModule(
 )
 
 #print(width, height)
-grid = CanvasGrid(agent_portrayal, width, height, 500, 500)
+grid = CityCanvasGrid(agent_portrayal, width, height, 500, 500)
 
 
 
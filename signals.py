@@ -0,0 +1,289 @@
+import heapq
+import numpy as np
+from collections import deque
+
+# Celdas hacia adelante de un semaforo que cuentan como parte del cruce
+BOX_REACH = 2
+# Celdas hacia atras de cada semaforo donde se miden las filas
+DETECTOR_LENGTH = 8
+# Distancia maxima para buscar el siguiente cruce de un corredor (ola verde)
+WAVE_REACH = 40
+
+MIN_GREEN = 3
+MAX_GREEN = 30
+CROSS_GREEN = 7  # Verde base de una fase sin semaforo (calle transversal)
+
+
+class Phase:
+    """
+    Fase de un cruce: semaforos que estan en verde al mismo tiempo.
+    detectors son las celdas donde se cuentan los coches que esperan esta fase.
+    Una fase sin semaforos es la calle transversal de un cruce con un solo acceso.
+    """
+
+    def __init__(self, lights, detectors, baseGreen):
+        self.lights = lights
+        self.detectorX = np.array([c[0] for c in detectors], dtype=np.intp)
+        self.detectorY = np.array([c[1] for c in detectors], dtype=np.intp)
+        self.baseGreen = baseGreen
+
+    def queue(self, carIds):
+        return int((carIds[self.detectorX, self.detectorY] >= 0).sum())
+
+
+class IntersectionController:
+    """
+    Controla todos los semaforos de un cruce, una fase en verde a la vez.
+    El verde de cada fase se reparte segun las filas medidas al empezarla
+    (con su verde base como peso); se corta antes si su fila se vacia y otra fase
+    espera, y se extiende si ninguna otra fase tiene coches.
+    """
+
+    def __init__(self, model, phases, current=0):
+        self.model = model
+        self.phases = phases
+        self.cycle = sum(p.baseGreen for p in phases)
+        self.current = current
+        self.elapsed = 0
+        self.green = phases[current].baseGreen
+        for i, phase in enumerate(phases):
+            for light in phase.lights:
+                light.go = i == current
+
+    def split(self, index, queues):
+        # Verde proporcional a verde base * (fila + 1), dentro de [MIN_GREEN, MAX_GREEN]
+        weights = [p.baseGreen * (q + 1) for p, q in zip(self.phases, queues)]
+        green = round(self.cycle * weights[index] / sum(weights))
+        return min(max(green, MIN_GREEN), MAX_GREEN)
+
+    def setPhase(self, index, green):
+        # Regresa los semaforos que cambiaron
+        changes = self.model.changes
+        changed = self.phases[self.current].lights + self.phases[index].lights
+        for light in self.phases[self.current].lights:
+            light.go = False
+            changes.lightChanged(light)
+        for light in self.phases[index].lights:
+            light.go = True
+            changes.lightChanged(light)
+        self.current = index
+        self.elapsed = 0
+        self.green = green
+        return changed
+
+    def step(self):
+        # Regresa los semaforos que cambiaron en este step
+        self.elapsed += 1
+        if len(self.phases) < 2:
+            return []
+
+        carIds = self.model.occupancy.carIds
+        if self.elapsed < self.green:
+            # Antes de su verde solo se corta si la fila ya se vacio
+            if self.elapsed < min(MIN_GREEN, self.green):
+                return []
+            if self.phases[self.current].queue(carIds) > 0:
+                return []
+
+        queues = [p.queue(carIds) for p in self.phases]
+        n = len(self.phases)
+        for k in range(1, n):
+            index = (self.current + k) % n
+            if queues[index] > 0:
+                return self.setPhase(index, self.split(index, queues))
+        # Nadie mas espera: seguimos en verde
+        return []
+
+    def getState(self):
+        # El go de cada semaforo se guarda aparte, con los semaforos
+        return (self.current, self.elapsed, self.green)
+
+    def setState(self, state):
+        self.current, self.elapsed, self.green = state
+
+    def delayPhase(self, index, delay):
+        # Arranca con la fase anterior a index, para que index empiece en `delay` steps
+        previous = (index - 1) % len(self.phases)
+        self.setPhase(previous, max(1, delay % self.cycle))
+
+
+class LightTimer:
+    """
+    Semaforos de ciclo fijo manejados por eventos: un heap con el step en que
+    cambia cada semaforo. Cada step solo se tocan los semaforos que cambian;
+    es lo mismo que llamar Traffic_Light.step en todos.
+    """
+
+    def __init__(self, lights):
+        self.now = 0
+        self.events = [
+            (light.cycle - light.cur, i, light) for i, light in enumerate(lights)
+        ]
+        heapq.heapify(self.events)
+
+    def step(self):
+        # Regresa los semaforos que cambiaron en este step
+        self.now += 1
+        changed = []
+        while self.events and self.events[0][0] <= self.now:
+            _, i, light = heapq.heappop(self.events)
+            light.flip()
+            changed.append(light)
+            heapq.heappush(self.events, (self.now + light.cycle, i, light))
+        return changed
+
+
+    def getState(self):
+        # Los semaforos van por su indice en la lista con la que se creo el timer
+        return (self.now, [(due, i) for due, i, _ in self.events])
+
+    def setState(self, state, lights):
+        self.now, events = state
+        self.events = [(due, i, lights[i]) for due, i in events]
+        heapq.heapify(self.events)
+
+
+def _union(parent, a, b):
+    while parent[a] != a:
+        a = parent[a]
+    while parent[b] != b:
+        b = parent[b]
+    if a != b:
+        parent[max(a, b)] = min(a, b)
+
+
+def _find(parent, a):
+    while parent[a] != a:
+        a = parent[a]
+    return a
+
+
+def _forward(graph, cell, reach):
+    # Celdas siguiendo derecho desde cell, sin incluirla
+    cells = []
+    for _ in range(reach):
+        moves = graph.get(cell)
+        if not moves:
+            break
+        cell = moves[0]
+        cells.append(cell)
+    return cells
+
+
+def _upstream(straightFeeders, cells, length):
+    # Celdas hacia atras (solo entradas derechas) desde cells, incluyendolas
+    found = list(cells)
+    frontier = list(cells)
+    for _ in range(length):
+        frontier = [f for c in frontier for f in straightFeeders.get(c, [])]
+        found += frontier
+    return found
+
+
+def buildControllers(model):
+    """
+    Agrupa los semaforos del modelo en cruces y crea un IntersectionController por cruce.
+    Un acceso son semaforos vecinos con la misma direccion; dos accesos son del mismo
+    cruce si sus celdas hacia adelante se tocan. Cada acceso es una fase.
+    Tambien desfasa los cruces de un mismo corredor (ola verde): un cruce empieza
+    su fase del corredor `distancia` steps despues que el cruce anterior.
+    """
+    graph = model.graph
+    lights = model.occupancy.lights
+    positions = sorted(lights)
+
+    straightFeeders = {}
+    for cell, moves in graph.items():
+        straightFeeders.setdefault(moves[0], []).append(cell)
+
+    # Accesos: semaforos vecinos con la misma direccion
+    parent = {p: p for p in positions}
+    for p in positions:
+        for d in ((1, 0), (0, 1)):
+            q = (p[0] + d[0], p[1] + d[1])
+            if q in lights and lights[q].direction == lights[p].direction:
+                _union(parent, p, q)
+    approaches = {}
+    for p in positions:
+        approaches.setdefault(_find(parent, p), []).append(p)
+
+    # Cruces: accesos cuyas celdas hacia adelante se tocan
+    box = {root: {c for p in cells for c in _forward(graph, p, BOX_REACH)} for root, cells in approaches.items()}
+    roots = sorted(approaches)
+    parent = {r: r for r in roots}
+    owner = {}
+    for root in roots:
+        for cell in box[root]:
+            if cell in owner:
+                _union(parent, owner[cell], root)
+            else:
+                owner[cell] = root
+    intersections = {}
+    for root in roots:
+        intersections.setdefault(_find(parent, root), []).append(root)
+
+    controllers = []
+    phaseOf = {}  # posicion del semaforo -> (controlador, fase)
+    for group in intersections.values():
+        phases = []
+        current = None
+        for root in group:
+            cells = approaches[root]
+            phaseLights = [lights[p] for p in cells]
+            green = max(light.green for light in phaseLights)
+            detectors = _upstream(straightFeeders, cells, DETECTOR_LENGTH)
+            if current is None and any(light.go for light in phaseLights):
+                current = len(phases)
+            phases.append(Phase(phaseLights, detectors, green))
+
+        if len(phases) == 1:
+            # Un solo acceso con semaforo: la fase en rojo es para la calle transversal
+            cells = approaches[group[0]]
+            own = set(cells) | box[group[0]]
+            cross = [
+                f for c in sorted(box[group[0]]) for f in straightFeeders.get(c, [])
+                if f not in own and f not in lights
+            ]
+            if cross:
+                detectors = _upstream(straightFeeders, cross, DETECTOR_LENGTH - 1)
+                phases.append(Phase([], detectors, CROSS_GREEN))
+
+        if current is None:  # Acceso en rojo: empieza la ultima fase
+            current = len(phases) - 1
+        controller = IntersectionController(model, phases, current)
+        controllers.append(controller)
+        for i, phase in enumerate(phases):
+            for light in phase.lights:
+                phaseOf[light.pos] = (controller, i)
+
+    # Ola verde: siguiendo cada acceso hacia adelante hasta el semaforo del siguiente cruce
+    links = {}
+    for controller in controllers:
+        for i, phase in enumerate(controller.phases):
+            for light in phase.lights:
+                distance = 0
+                for cell in _forward(graph, light.pos, WAVE_REACH):
+                    distance += 1
+                    if cell in phaseOf and phaseOf[cell][0] is not controller:
+                        if lights[cell].direction == light.direction:
+                            links.setdefault(controller, []).append((i, phaseOf[cell], distance))
+                        break
+
+    # Cada cruce colocado: (fase del corredor, step en que empieza su verde)
+    started = {}
+    for controller in controllers:
+        if controller in started:
+            continue
+        started[controller] = (controller.current, 0)
+        queue = deque([controller])
+        while queue:
+            upstream = queue.popleft()
+            phase, start = started[upstream]
+            for i, (downstream, j), distance in links.get(upstream, []):
+                if downstream in started or i != phase:
+                    continue
+                started[downstream] = (j, start + distance)
+                downstream.delayPhase(j, start + distance)
+                queue.append(downstream)
+
+    return controllers
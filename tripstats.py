@@ -0,0 +1,104 @@
+import math
+import numpy as np
+
+
+class TripStats:
+    """
+    Distribucion de la duracion (en steps) de los viajes que ya llegaron.
+        hist[i] -> viajes de i steps, para i < maxSteps
+        hist[maxSteps] -> viajes de maxSteps o mas (no se tiran)
+    Ademas lleva conteo, media, desviacion, minimo y maximo en linea, y percentiles:
+    exactos dentro del histograma y, para los viajes largos, con un sketch de
+    buckets logaritmicos (error relativo de a lo mas relativeAccuracy).
+    recent son los viajes que terminaron en el step actual (ver startStep).
+    """
+
+    def __init__(self, maxSteps, relativeAccuracy=0.01):
+        self.maxSteps = maxSteps
+        self.hist = np.zeros(maxSteps + 1, dtype=np.int64)
+        self.gamma = (1 + relativeAccuracy) / (1 - relativeAccuracy)
+        self.logGamma = math.log(self.gamma)
+        self.overflow = {}  # bucket logaritmico -> viajes, solo los de maxSteps o mas
+        self.count = 0
+        self.total = 0
+        self.totalSq = 0
+        self.min = None
+        self.max = 0
+        self.recent = []
+
+    def startStep(self):
+        # Lista nueva para que el DataCollector se quede con la del step anterior
+        self.recent = []
+
+    def add(self, steps):
+        self.count += 1
+        self.total += steps
+        self.totalSq += steps * steps
+        self.min = steps if self.min is None else min(self.min, steps)
+        self.max = max(self.max, steps)
+        self.recent.append(steps)
+        if steps < self.maxSteps:
+            self.hist[steps] += 1
+        else:
+            self.hist[self.maxSteps] += 1
+            key = math.ceil(math.log(steps) / self.logGamma)
+            self.overflow[key] = self.overflow.get(key, 0) + 1
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def std(self):
+        if not self.count:
+            return 0.0
+        mean = self.mean()
+        return math.sqrt(max(self.totalSq / self.count - mean * mean, 0.0))
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        cumulative = np.cumsum(self.hist[: self.maxSteps])
+        if rank < cumulative[-1]:
+            return float(np.searchsorted(cumulative, rank, side="right"))
+
+        seen = cumulative[-1]
+        for key in sorted(self.overflow):
+            seen += self.overflow[key]
+            if rank < seen:
+                estimate = 2 * self.gamma ** key / (self.gamma + 1)
+                return float(min(max(estimate, self.maxSteps), self.max))
+        return float(self.max)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.mean(),
+            "std": self.std(),
+            "min": self.min,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+    def getState(self):
+        return (
+            self.hist.copy(), dict(self.overflow), self.count, self.total, self.totalSq,
+            self.min, self.max, list(self.recent),
+        )
+
+    def setState(self, state):
+        hist, overflow, self.count, self.total, self.totalSq, self.min, self.max, recent = state
+        self.hist = hist.copy()
+        self.overflow = dict(overflow)
+        self.recent = list(recent)
+
+    def reporters(self):
+        """Reporters para el DataCollector: los viajes del step y un resumen."""
+        return {
+            "Trips": lambda m: self.recent,
+            "Trip Mean": lambda m: self.mean(),
+            "Trip p50": lambda m: self.quantile(0.5),
+            "Trip p95": lambda m: self.quantile(0.95),
+        }